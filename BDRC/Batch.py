@@ -0,0 +1,230 @@
+import os
+import cv2
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from BDRC.Data import (
+    Encoding,
+    LayoutDetectionConfig,
+    LineDetectionConfig,
+    OCRModelConfig,
+    OCRFailure,
+    OpStatus,
+    Platform,
+    SessionConfig,
+    TPSMode
+)
+from BDRC.Cache import DetectionCache
+from BDRC.Inference import OCRPipeline
+from BDRC.Sessions import get_model_cache_dir, set_model_cache_dir
+
+"""
+Page-parallel OCR on a pool of worker processes, so that the Python-level work of the pipeline (contour sorting,
+tps checks, line extraction) is not serialized on the GIL. Each worker builds its own OCRPipeline once and keeps it
+warm for all pages it receives. The workers are started via 'spawn', since forking a process that runs Qt threads is
+not safe. A spawned worker imports the engine modules and the main module of the parent process (as __mp_main__), so
+the entry points only import Qt under their main guard, see main.py.
+"""
+
+_pipeline: OCRPipeline | None = None
+
+
+def get_default_workers() -> int:
+    # every worker holds its own copy of the models, so this leaves some headroom instead of using all logical cores
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+def _init_worker(
+        platform: Platform,
+        ocr_config: OCRModelConfig,
+        line_config: LineDetectionConfig | LayoutDetectionConfig,
+        session_config: SessionConfig,
+        memory_budget: int,
+        model_cache_dir: str | None,
+        detection_cache_dir: str | None,
+        coarse_scale: float | None
+):
+    global _pipeline
+
+    set_model_cache_dir(model_cache_dir)
+    detection_cache = DetectionCache(detection_cache_dir) if detection_cache_dir is not None else None
+    _pipeline = OCRPipeline(
+        platform,
+        ocr_config,
+        line_config,
+        memory_budget=memory_budget,
+        session_config=session_config,
+        detection_cache=detection_cache,
+        # the pages of a batch are not revisited, so their intermediates are not kept
+        max_page_states=0,
+        coarse_scale=coarse_scale
+    )
+
+
+def _run_page(image_path: str, ocr_args: Dict):
+    img = cv2.imread(image_path)
+
+    if img is None:
+        return OpStatus.FAILED, OCRFailure.ImageNotReadable
+
+    return _pipeline.run_ocr(img, **ocr_args)
+
+
+class OCRProcessPool:
+    """
+    Runs the OCR of a list of images on a pool of worker processes. The results are yielded in the order of the
+    images, e.g.:
+
+        with OCRProcessPool(platform, ocr_config, line_config, workers=4) as pool:
+            for idx, status, result in pool.run(image_paths, k_factor=2.0):
+                ...
+    """
+
+    def __init__(
+            self,
+            platform: Platform,
+            ocr_config: OCRModelConfig,
+            line_config: LineDetectionConfig | LayoutDetectionConfig,
+            workers: int | None = None,
+            memory_budget: int = 1024,
+            session_config: SessionConfig | None = None,
+            detection_cache_dir: str | None = None,
+            coarse_scale: float | None = None
+    ):
+        self.workers = workers if workers is not None else get_default_workers()
+
+        if session_config is None:
+            # splits the cores between the workers instead of letting every session spawn a thread per core
+            session_config = SessionConfig(intra_op_threads=max(1, (os.cpu_count() or 1) // self.workers))
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                platform,
+                ocr_config,
+                line_config,
+                session_config,
+                memory_budget,
+                get_model_cache_dir(),
+                detection_cache_dir,
+                coarse_scale
+            )
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=exc_type is None)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def run(
+            self,
+            image_paths: List[str],
+            k_factor: float = 2.5,
+            bbox_tolerance: float = 4.0,
+            merge_lines: bool = True,
+            use_tps: bool = False,
+            tps_mode: TPSMode = TPSMode.GLOBAL,
+            tps_threshold: float = 0.25,
+            target_encoding: Encoding = Encoding.Unicode,
+            batch_size: int = 8,
+            beam_threshold: float = 0.8,
+            should_stop: Callable[[], bool] | None = None
+    ) -> Iterator[Tuple[int, OpStatus, Tuple | None]]:
+        """
+        Yields (index, status, result) per image with the same status and result as OCRPipeline.run_ocr.
+        Only a few pages per worker are queued ahead, so that a stop request does not have to wait for the whole batch.
+        """
+        ocr_args = {
+            "k_factor": k_factor,
+            "bbox_tolerance": bbox_tolerance,
+            "merge_lines": merge_lines,
+            "use_tps": use_tps,
+            "tps_mode": tps_mode,
+            "tps_threshold": tps_threshold,
+            "target_encoding": target_encoding,
+            "batch_size": batch_size,
+            "beam_threshold": beam_threshold
+        }
+        max_pending = 2 * self.workers
+        pending: Dict[int, Future] = {}
+        next_idx = 0
+
+        for idx in range(len(image_paths)):
+            while next_idx < len(image_paths) and len(pending) < max_pending:
+                pending[next_idx] = self.executor.submit(_run_page, image_paths[next_idx], ocr_args)
+                next_idx += 1
+
+            if should_stop is not None and should_stop():
+                for future in pending.values():
+                    future.cancel()
+                return
+
+            future = pending.pop(idx)
+
+            try:
+                status, result = future.result()
+            except Exception as e:
+                logging.error(f"Failed to run OCR on {image_paths[idx]}: {e}")
+                status, result = OpStatus.FAILED, OCRFailure.Error
+
+            yield idx, status, result
+
+
+class SharedOCRProcessPool:
+    """
+    Keeps one OCRProcessPool alive across batches, so that the workers don't load the models again for every batch.
+    The pool is started again if a batch uses other models or settings.
+    """
+
+    def __init__(self):
+        self._pool: OCRProcessPool | None = None
+        self._pool_args: Tuple | None = None
+        self._lock = threading.Lock()
+
+    def get(
+            self,
+            platform: Platform,
+            ocr_config: OCRModelConfig,
+            line_config: LineDetectionConfig | LayoutDetectionConfig,
+            workers: int | None = None,
+            memory_budget: int = 1024,
+            session_config: SessionConfig | None = None,
+            detection_cache_dir: str | None = None,
+            coarse_scale: float | None = None
+    ) -> OCRProcessPool:
+        pool_args = (
+            platform,
+            ocr_config,
+            line_config,
+            workers,
+            memory_budget,
+            session_config,
+            detection_cache_dir,
+            coarse_scale
+        )
+
+        with self._lock:
+            if self._pool is None or self._pool_args != pool_args:
+                if self._pool is not None:
+                    self._pool.shutdown()
+
+                self._pool = OCRProcessPool(*pool_args)
+                self._pool_args = pool_args
+
+            return self._pool
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=wait)
+                self._pool = None
+                self._pool_args = None
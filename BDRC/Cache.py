@@ -0,0 +1,358 @@
+import os
+import cv2
+import json
+import pickle
+import inspect
+import hashlib
+import logging
+import threading
+import numpy as np
+from enum import Enum
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy.typing as npt
+from BDRC.Data import LayoutDetectionConfig, LineDetectionConfig, LineDetectionResult, OCRModelConfig, OpStatus
+from BDRC.Utils import create_dir
+
+"""
+Persistent caches for the OCR results, so that rerunning a batch after a settings change only processes the pages that
+are affected by it. The entries are addressed by a hash of the image content, the models and the settings, and the least
+recently used entries are evicted once the cache grows beyond its size limit.
+"""
+
+# bump this whenever the layout of the cached entries changes
+CACHE_VERSION = 2
+
+
+class DiskCache:
+    """
+    A directory of pickled entries with a size limit. Reading an entry updates its modification time, which is used
+    as the access time for evicting the least recently used entries. Pinned entries are not evicted, e.g. the cached
+    pages of a batch until they are read.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pinned: Counter = Counter()
+        create_dir(self.cache_dir)
+        self._size = sum(os.path.getsize(x) for x in self._list_entries())
+
+    def _list_entries(self) -> List[str]:
+        return [
+            os.path.join(self.cache_dir, x) for x in os.listdir(self.cache_dir) if x.endswith(".pkl")
+        ]
+
+    def _get_entry_file(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def contains(self, key: str) -> bool:
+        return os.path.isfile(self._get_entry_file(key))
+
+    def pin(self, keys: List[str]) -> None:
+        with self._lock:
+            self._pinned.update(keys)
+
+    def unpin(self, keys: List[str]) -> None:
+        with self._lock:
+            self._pinned.subtract(keys)
+            self._pinned = +self._pinned
+
+    def get(self, key: str):
+        entry_file = self._get_entry_file(key)
+
+        try:
+            with open(entry_file, "rb") as f:
+                entry = pickle.load(f)
+            os.utime(entry_file)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Failed to read cache entry {entry_file}: {e}")
+            return None
+
+    def put(self, key: str, entry) -> None:
+        entry_file = self._get_entry_file(key)
+        tmp_file = f"{entry_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            with open(tmp_file, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            with self._lock:
+                old_size = os.path.getsize(entry_file) if os.path.isfile(entry_file) else 0
+                os.replace(tmp_file, entry_file)
+                self._size += os.path.getsize(entry_file) - old_size
+
+                if self._size > self.max_size:
+                    self._evict()
+
+        except OSError as e:
+            logging.warning(f"Failed to write cache entry {entry_file}: {e}")
+
+    def _evict(self) -> None:
+        # evicting down to 90% of the limit, so that not every following put has to list the directory again
+        entries = []
+
+        for entry_file in self._list_entries():
+            try:
+                stat = os.stat(entry_file)
+                entries.append((stat.st_mtime, stat.st_size, entry_file))
+            except OSError:
+                pass
+
+        entries.sort()
+        self._size = sum(x[1] for x in entries)
+
+        for _, size, entry_file in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            if self._pinned[os.path.basename(entry_file)[:-len(".pkl")]] > 0:
+                continue
+            try:
+                os.remove(entry_file)
+                self._size -= size
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            for entry_file in self._list_entries():
+                os.remove(entry_file)
+            self._size = 0
+
+
+_image_hashes: Dict[Tuple[str, int, int], str] = {}
+
+
+def get_image_hash(image_path: str) -> str:
+    """
+    Returns the sha256 of an image file, memoized by path, size and modification time
+    """
+    stat = os.stat(image_path)
+    memo_key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+    image_hash = _image_hashes.get(memo_key)
+
+    if image_hash is None:
+        file_hash = hashlib.sha256()
+
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+
+        image_hash = file_hash.hexdigest()
+        _image_hashes[memo_key] = image_hash
+
+    return image_hash
+
+
+def get_image_digest(image: npt.NDArray) -> str:
+    """
+    Returns a hash of the pixels, shape and dtype of an image
+    """
+    image_hash = hashlib.sha256(f"{image.shape}:{image.dtype}".encode("utf-8"))
+    image_hash.update(np.ascontiguousarray(image).data)
+
+    return image_hash.hexdigest()
+
+
+def _to_key_value(value):
+    return value.name if isinstance(value, Enum) else value
+
+
+class OCRResultCache:
+    """
+    Caches the results of OCRPipeline.run_ocr per page. The key covers the image content, the OCR model and its version,
+    the line or layout model and all settings that change the result, e.g. k_factor, merge_lines or the output encoding,
+    as well as the settings of the line detection that the pipeline was built with (e.g. the coarse_scale).
+    """
+
+    # run_ocr arguments that don't change the result
+    IGNORED_ARGS = ["batch_size"]
+
+    def __init__(self, cache_dir: str, max_size: int = 512 * 1024 * 1024):
+        self.cache = DiskCache(cache_dir, max_size)
+
+    @staticmethod
+    def _get_run_args(ocr_args: Dict) -> Dict:
+        # filling in the defaults of run_ocr, so that the same settings give the same key regardless of the caller
+        from BDRC.Inference import OCRPipeline
+
+        parameters = inspect.signature(OCRPipeline.run_ocr).parameters
+        run_args = {k: v.default for k, v in parameters.items() if v.default is not inspect.Parameter.empty}
+        run_args.update(ocr_args)
+
+        return run_args
+
+    def build_key(
+            self,
+            image_path: str,
+            ocr_config: OCRModelConfig,
+            line_config: LineDetectionConfig | LayoutDetectionConfig,
+            ocr_args: Dict,
+            detection_settings: Dict | None = None
+    ) -> str:
+        key = {
+            "cache_version": CACHE_VERSION,
+            "image": get_image_hash(image_path),
+            "ocr_model": os.path.abspath(ocr_config.model_file),
+            "ocr_version": ocr_config.version,
+            "line_model": os.path.abspath(line_config.model_file),
+            "patch_size": line_config.patch_size,
+            "classes": line_config.classes if isinstance(line_config, LayoutDetectionConfig) else None,
+            "settings": {k: _to_key_value(v) for k, v in self._get_run_args(ocr_args).items() if k not in self.IGNORED_ARGS},
+            "detection": detection_settings
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def contains(self, key: str) -> bool:
+        return self.cache.contains(key)
+
+    def pin(self, keys: List[str]) -> None:
+        self.cache.pin(keys)
+
+    def unpin(self, keys: List[str]) -> None:
+        self.cache.unpin(keys)
+
+    def get(self, key: str) -> Tuple | None:
+        entry = self.cache.get(key)
+
+        if entry is None:
+            return None
+
+        rot_mask = cv2.imdecode(np.frombuffer(entry["mask"], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+        return rot_mask, entry["lines"], entry["ocr_lines"], entry["angle"]
+
+    def put(self, key: str, result: Tuple) -> None:
+        rot_mask, lines, ocr_lines, angle = result
+        # the masks are binary, so they compress well as png
+        _, mask = cv2.imencode(".png", rot_mask)
+        entry = {
+            "mask": mask.tobytes(),
+            "lines": lines,
+            "ocr_lines": ocr_lines,
+            "angle": angle
+        }
+        self.cache.put(key, entry)
+
+
+class DetectionCache:
+    """
+    Caches the line detection of a page per detection model, so that running the same pages with another OCR model or
+    other extraction settings starts at the line extraction. The key covers the digest of the image (see get_image_digest),
+    the model file and the settings of the deskewing.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.cache = DiskCache(cache_dir, max_size)
+
+    def build_key(
+            self,
+            image_digest: str,
+            line_config: LineDetectionConfig | LayoutDetectionConfig,
+            settings: Dict | None = None
+    ) -> str:
+        model_stat = os.stat(line_config.model_file)
+        key = {
+            "cache_version": CACHE_VERSION,
+            "image": image_digest,
+            "model": os.path.abspath(line_config.model_file),
+            "model_size": model_stat.st_size,
+            "model_mtime": model_stat.st_mtime_ns,
+            "patch_size": line_config.patch_size,
+            "classes": line_config.classes if isinstance(line_config, LayoutDetectionConfig) else None,
+            "settings": settings
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> LineDetectionResult | None:
+        entry = self.cache.get(key)
+
+        if entry is None:
+            return None
+
+        rot_mask = cv2.imdecode(np.frombuffer(entry["mask"], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+        return LineDetectionResult(
+            rot_mask=rot_mask, line_contours=entry["line_contours"], angle=entry["angle"], blank=entry["blank"]
+        )
+
+    def put(self, key: str, detection: LineDetectionResult) -> None:
+        _, mask = cv2.imencode(".png", detection.rot_mask)
+        entry = {
+            "mask": mask.tobytes(),
+            "line_contours": detection.line_contours,
+            "angle": detection.angle,
+            "blank": detection.blank
+        }
+        self.cache.put(key, entry)
+
+
+def run_cached(
+        cache: OCRResultCache,
+        image_paths: List[str],
+        keys: List[str],
+        run: Callable[[List[str]], Iterator[Tuple[int, OpStatus, Tuple | None]]]
+) -> Iterator[Tuple[int, OpStatus, Tuple | None]]:
+    """
+    Yields (index, status, result) for all images in order, taking the cached results where available and running the
+    remaining images through run, e.g. OCRProcessPool.run or StagedOCRPipeline.run. New results are added to the cache.
+    Images without a key (e.g. files that can't be read) are always run. The cached pages are pinned until they are
+    read, so that the new results don't evict them. Cached entries that can't be read after all (e.g. corrupt files)
+    are run together after all other pages, so these pages come last.
+    """
+    # the cached results are only loaded when their turn comes, so that a large batch is not held in memory at once
+    missing = [idx for idx, key in enumerate(keys) if key is None or not cache.contains(key)]
+    missing_set = set(missing)
+    hit_keys = [key for idx, key in enumerate(keys) if idx not in missing_set]
+    unreadable = []
+    next_idx = 0
+
+    def yield_cached(until: int):
+        nonlocal next_idx
+
+        while next_idx < until:
+            result = cache.get(keys[next_idx])
+
+            if result is not None:
+                yield next_idx, OpStatus.SUCCESS, result
+            else:
+                unreadable.append(next_idx)
+
+            next_idx += 1
+
+    def run_pages(indices: List[int]):
+        nonlocal next_idx
+        processed = 0
+
+        for run_idx, status, result in run([image_paths[idx] for idx in indices]):
+            idx = indices[run_idx]
+            yield from yield_cached(idx)
+
+            if status == OpStatus.SUCCESS and keys[idx] is not None:
+                cache.put(keys[idx], result)
+
+            yield idx, status, result
+            next_idx = max(next_idx, idx + 1)
+            processed += 1
+
+        return processed == len(indices)
+
+    cache.pin(hit_keys)
+
+    try:
+        # the run stopped early, e.g. the batch was cancelled
+        if len(missing) > 0 and not (yield from run_pages(missing)):
+            return
+
+        yield from yield_cached(len(image_paths))
+
+        if len(unreadable) > 0:
+            yield from run_pages(unreadable)
+    finally:
+        cache.unpin(hit_keys)
@@ -1,15 +1,28 @@
+import threading
 from uuid import UUID
 from enum import Enum
 import numpy.typing as npt
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
-from PySide6.QtGui import QImage
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PySide6.QtGui import QImage
 
 class OpStatus(Enum):
     SUCCESS = 0
     FAILED = 1
 
 
+class OCRFailure(Enum):
+    """
+    The reason that is returned as the result of a page whose OCR failed
+    """
+    ImageNotReadable = 0
+    BlankPage = 1
+    NoLines = 2
+    Error = 3
+
+
 class Platform(Enum):
     Windows = 0
     Mac = 1
@@ -56,6 +69,18 @@ class TPSMode(Enum):
     LOCAL = 1
 
 
+class ExecutionMode(Enum):
+    Sequential = 0
+    Parallel = 1
+
+
+class OptimizationLevel(Enum):
+    Disabled = 0
+    Basic = 1
+    Extended = 2
+    All = 3
+
+
 class Language(Enum):
     English = 0
     German = 1
@@ -93,6 +118,7 @@ class OCRLine:
     guid: UUID
     text: str
     encoding: Encoding
+    confidence: float | None = None
 
 @dataclass
 class LayoutData:
@@ -120,7 +146,7 @@ class OCRData:
     guid: UUID
     image_path: str
     image_name: str
-    qimage: QImage
+    qimage: "QImage"
     ocr_lines: List[OCRLine] | None
     lines: List[Line] | None
     preview: npt.NDArray | None
@@ -156,6 +182,45 @@ class OCRModelConfig:
     version: str
 
 
+@dataclass(frozen=True)
+class SessionConfig:
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    optimization_level: OptimizationLevel = OptimizationLevel.All
+    execution_mode: ExecutionMode = ExecutionMode.Sequential
+
+
+@dataclass
+class LineDetectionResult:
+    rot_mask: npt.NDArray
+    line_contours: List[npt.NDArray]
+    angle: float
+    blank: bool = False
+
+
+@dataclass
+class PageState:
+    """
+    The intermediates of a page in the OCRPipeline. Each step stores the arguments it was run with, so that a
+    change of e.g. the k_factor only reruns the line extraction and the recognition.
+    """
+    detection: LineDetectionResult
+    image: npt.NDArray
+    filtered_contours: List[npt.NDArray]
+    tps_check: Tuple[float, List] | None = None
+    dewarped: Tuple[npt.NDArray, List[npt.NDArray], float] | None = None
+    local_tps_check: List[Tuple] | None = None
+    sort_args: Tuple | None = None
+    sorted_lines: List[Line] | None = None
+    extract_args: Tuple | None = None
+    line_images: List[npt.NDArray] | None = None
+    page_angle: float | None = None
+    recognition_args: Tuple | None = None
+    predictions: List[str] | None = None
+    confidences: List[float] | None = None
+    lock: threading.RLock = field(default_factory=threading.RLock)
+
+
 @dataclass
 class LineDataResult:
     guid: UUID
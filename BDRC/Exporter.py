@@ -75,7 +75,7 @@ class PageXMLExporter(Exporter):
         super().__init__(output_dir)
         logging.info("Init XML Exporter")
 
-    def get_text_line_block(self, coordinate, index: int, unicode_text: str):
+    def get_text_line_block(self, coordinate, index: int, unicode_text: str, confidence: float | None = None):
         text_line = etree.Element(
             "Textline", id="", custom=f"readingOrder {{index:{index};}}"
         )
@@ -89,6 +89,10 @@ class PageXMLExporter(Exporter):
         coords_points.attrib["points"] = text_line_coords
 
         text_equiv = etree.SubElement(text_line, "TextEquiv")
+
+        if confidence is not None:
+            text_equiv.attrib["conf"] = f"{confidence:.4f}"
+
         unicode_field = etree.SubElement(text_equiv, "Unicode")
         unicode_field.text = unicode_text
 
@@ -146,7 +150,10 @@ class PageXMLExporter(Exporter):
             if text_lines is not None and len(text_lines) > 0:
                 text_region.append(
                     self.get_text_line_block(
-                        coordinate=line, index=l_idx, unicode_text=text_lines[l_idx].text
+                        coordinate=line,
+                        index=l_idx,
+                        unicode_text=text_lines[l_idx].text,
+                        confidence=text_lines[l_idx].confidence
                     )
                 )
             else:
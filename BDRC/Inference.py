@@ -1,21 +1,26 @@
 import cv2
+import math
+import threading
+import logging
 import pyewts
 import numpy as np
 import numpy.typing as npt
 import onnxruntime as ort
-from typing import List, Union
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Tuple, Union
 
-
-from scipy.special import softmax
 from Config import COLOR_DICT, CHARSETENCODER
 from BDRC.Data import (
+    LineDetectionResult,
+    PageState,
     OCRLine,
+    OCRFailure,
     OpStatus,
     TPSMode,
     Encoding,
     OCRModelConfig,
     LineDetectionConfig,
-    LayoutDetectionConfig, Platform, CharsetEncoder
+    LayoutDetectionConfig, Platform, CharsetEncoder, SessionConfig
 )
 
 from pyctcdecode import build_ctcdecoder
@@ -26,17 +31,20 @@ from BDRC.Utils import (
     optimize_countour,
     preprocess_image,
     binarize,
-    normalize,
     sort_lines_by_threshold2,
-    stitch_predictions,
-    tile_image,
-    sigmoid,
     pad_to_height,
     pad_to_width,
     build_raw_line_data,
+    build_line_mask_data,
     filter_line_contours,
-    check_for_tps, get_execution_providers
+    check_for_tps,
+    check_line_tps,
+    get_line_images_via_local_tps,
+    get_text_regions,
+    rotate_from_angle
 )
+from BDRC.Cache import DetectionCache, get_image_digest
+from BDRC.Sessions import get_inference_session
 
 
 class CTCDecoder:
@@ -54,6 +62,11 @@ class CTCDecoder:
         if self.add_blank:
             self.ctc_vocab.insert(0, " ")
         self.ctc_decoder = build_ctcdecoder(self.ctc_vocab)
+        # the greedy decoding uses the labels as normalized by pyctcdecode, which maps e.g. "_" or "<pad>" to the
+        # ctc blank "" or appends the blank to the end of the vocabulary
+        decoder_labels = self.ctc_decoder._alphabet.labels
+        self.blank_idx = decoder_labels.index("")
+        self._labels = np.array(decoder_labels, dtype=object)
 
     def encode(self, label: str):
         return [self.charset.index(x) + 1 for x in label]
@@ -64,41 +77,148 @@ class CTCDecoder:
     def ctc_decode(self, logits):
         return self.ctc_decoder.decode(logits).replace(" ", "")
 
+    def greedy_decode(self, logits: npt.NDArray) -> Tuple[List[str], npt.NDArray]:
+        """
+        Decodes a batch of logits of shape (batch, time, vocab) by taking the best label of each frame, collapsing
+        the repeated labels and dropping the blanks. Returns the texts and the confidence of each line, which is the
+        probability of the least certain frame of the best path.
+        """
+        best_path = logits.argmax(axis=-1)
+        best_logits = np.take_along_axis(logits, best_path[..., None], axis=-1)
+        # the softmax probability of the best label is 1 / sum(exp(z - z_best))
+        frame_probs = 1.0 / np.exp(logits - best_logits).sum(axis=-1)
+        confidences = frame_probs.min(axis=-1)
+
+        is_label = best_path != self.blank_idx
+        is_label[:, 1:] &= best_path[:, 1:] != best_path[:, :-1]
+
+        texts = [
+            "".join(self._labels[path[keep]]).replace(" ", "") for path, keep in zip(best_path, is_label)
+        ]
+
+        return texts, confidences
+
 
 class Detection:
-    def __init__(self, platform: Platform, config: LineDetectionConfig | LayoutDetectionConfig):
+    """
+    Runs a tiled segmentation model over a page. Tiles are streamed through the session in batches whose size is
+    derived from memory_budget (in MB), so that the peak memory doesn't scale with the size of the page.
+    Note: the activation factor is a rough estimate of the intermediate tensors of the network relative to the
+    input and output of a tile.
+    Tiles whose share of ink pixels after the binarization is not above min_tile_ink, e.g. the padding or empty
+    margins, are not run through the model and stay empty in the prediction.
+    """
+    def __init__(
+            self,
+            platform: Platform,
+            config: LineDetectionConfig | LayoutDetectionConfig,
+            memory_budget: int = 1024,
+            activation_factor: int = 32,
+            session_config: SessionConfig | None = None,
+            min_tile_ink: float = 0.0002
+    ):
         self.platform = platform
         self.config = config
         self._config_file = config
         self._onnx_model_file = config.model_file
         self._patch_size = config.patch_size
-        self._execution_providers = get_execution_providers()
-        self._inference = ort.InferenceSession(
-            self._onnx_model_file, providers=self._execution_providers
-        )
+        self._memory_budget = memory_budget
+        self._activation_factor = activation_factor
+        self._min_tile_ink = min_tile_ink
+        self._output_channels = len(config.classes) if isinstance(config, LayoutDetectionConfig) else 1
+        self._inference = get_inference_session(self._onnx_model_file, session_config)
+
+    def _get_tile_batch_size(self) -> int:
+        tile_bytes = self._patch_size * self._patch_size * 4 * (3 + self._output_channels)
+        tile_bytes *= self._activation_factor
+
+        return max(1, (self._memory_budget * 1024 * 1024) // tile_bytes)
 
     def _preprocess_image(self, image: npt.NDArray, patch_size: int = 512):
+        """
+        Returns the padded page binarized to a single channel. The page is binarized as a whole instead of per tile,
+        which also gives the adaptive threshold the context of the neighbouring tiles at the tile borders.
+        """
         padded_img, pad_x, pad_y = preprocess_image(image, patch_size)
-        tiles, y_steps = tile_image(padded_img, patch_size)
-        tiles = [binarize(x) for x in tiles]
-        tiles = [normalize(x) for x in tiles]
-        tiles = np.array(tiles)
+        padded_img = binarize(padded_img, to_rgb=False)
+
+        return padded_img, pad_x, pad_y
+
+    def _get_ink_tiles(self, padded_img: npt.NDArray) -> List[Tuple[int, int]]:
+        """
+        Returns the (y, x) positions of the tiles of the binarized page that contain ink
+        """
+        patch_size = self._patch_size
+        y_steps = padded_img.shape[0] // patch_size
+        x_steps = padded_img.shape[1] // patch_size
+
+        ink_pixels = (padded_img == 0).reshape(y_steps, patch_size, x_steps, patch_size).sum(axis=(1, 3))
+        ink_tiles = ink_pixels > self._min_tile_ink * patch_size * patch_size
+
+        return [(int(y), int(x)) for y, x in zip(*np.nonzero(ink_tiles))]
+
+    def _iter_tile_batches(
+            self, padded_img: npt.NDArray, tile_positions: List[Tuple[int, int]]
+    ) -> Iterator[Tuple[List[Tuple[int, int]], npt.NDArray]]:
+        """
+        Yields the (y, x) positions and the normalized tiles of the binarized page for each batch, already in the
+        (N, 3, H, W) layout of the model input
+        """
+        patch_size = self._patch_size
+        batch_size = min(self._get_tile_batch_size(), len(tile_positions))
+        # the batch is refilled for each yield, the predictions of a batch are done before the next one is requested
+        batch = np.empty((batch_size, 3, patch_size, patch_size), dtype=np.float32)
+
+        for start in range(0, len(tile_positions), batch_size):
+            batch_positions = tile_positions[start:start + batch_size]
 
-        return padded_img, tiles, y_steps, pad_x, pad_y
+            for tile, (y, x) in zip(batch, batch_positions):
+                tile_img = padded_img[y * patch_size:(y + 1) * patch_size, x * patch_size:(x + 1) * patch_size]
+                np.divide(tile_img, np.float32(255.0), out=tile[0])
+                # the binarized page is gray, so all channels are the same
+                tile[1:] = tile[0]
+
+            yield batch_positions, batch[:len(batch_positions)]
+
+    def _stitch_batch(
+            self, merged_image: npt.NDArray, prediction: npt.NDArray, tile_positions: List[Tuple[int, int]]
+    ) -> None:
+        patch_size = self._patch_size
+
+        for (y, x), tile_prediction in zip(tile_positions, prediction):
+            merged_image[y * patch_size:(y + 1) * patch_size, x * patch_size:(x + 1) * patch_size] = tile_prediction
 
     def _crop_prediction(
-            self, image: npt.NDArray, prediction: npt.NDArray, x_pad: int, y_pad: int
+            self,
+            image: npt.NDArray,
+            prediction: npt.NDArray,
+            x_pad: int,
+            y_pad: int,
+            labels: List[int] | None = None
     ) -> npt.NDArray:
+        """
+        Crops the padding off a stitched 0/1 mask, or a label map of the given labels, and resizes it to the size of
+        the page. The mask is interpolated as float and truncated, so a pixel is only set if all pixels it is
+        interpolated from are set.
+        """
         x_lim = prediction.shape[1] - x_pad
         y_lim = prediction.shape[0] - y_pad
+        dsize = (image.shape[1], image.shape[0])
 
         prediction = prediction[:y_lim, :x_lim]
-        prediction = cv2.resize(prediction, dsize=(image.shape[1], image.shape[0]))
 
-        return prediction
+        if labels is None:
+            return (cv2.resize(prediction.astype(np.float32), dsize=dsize) >= 1).astype(np.uint8)
+
+        label_map = np.zeros((image.shape[0], image.shape[1]), dtype=np.uint8)
+
+        for label in labels:
+            label_mask = cv2.resize((prediction == label).astype(np.float32), dsize=dsize)
+            label_map[label_mask >= 1] = label
+
+        return label_map
 
     def _predict(self, image_batch: npt.NDArray):
-        image_batch = np.transpose(image_batch, axes=[0, 3, 1, 2])
         ort_batch = ort.OrtValue.ortvalue_from_numpy(image_batch)
         prediction = self._inference.run_with_ort_values(
             ["output"], {"input": ort_batch}
@@ -112,27 +232,101 @@ class Detection:
 
 
 class LineDetection(Detection):
-    def __init__(self, platform: Platform, config: LineDetectionConfig) -> None:
-        super().__init__(platform, config)
-
-    def predict(self, image: npt.NDArray, class_threshold: float = 0.9) -> npt.NDArray:
-        _, tiles, y_steps, pad_x, pad_y = self._preprocess_image(
-            image, patch_size=self._patch_size)
-        prediction = self._predict(tiles)
-        prediction = np.squeeze(prediction, axis=1)
-        prediction = sigmoid(prediction)
-        prediction = np.where(prediction > class_threshold, 1.0, 0.0)
-        merged_image = stitch_predictions(prediction, y_steps=y_steps)
+    """
+    With a coarse_scale, the lines are detected in two passes: the model first runs on the page downscaled by
+    coarse_scale to find the text areas, and then only the full resolution tiles within these areas are run, so that
+    empty margins and illustrations are skipped.
+    """
+    def __init__(
+            self,
+            platform: Platform,
+            config: LineDetectionConfig,
+            memory_budget: int = 1024,
+            session_config: SessionConfig | None = None,
+            min_tile_ink: float = 0.0002,
+            coarse_scale: float | None = None
+    ) -> None:
+        super().__init__(platform, config, memory_budget, session_config=session_config, min_tile_ink=min_tile_ink)
+        self._coarse_scale = coarse_scale
+
+    def _predict_tiles(
+            self, padded_img: npt.NDArray, tile_positions: List[Tuple[int, int]], class_threshold: float
+    ) -> npt.NDArray:
+        merged_image = np.zeros(padded_img.shape[:2], dtype=np.uint8)
+
+        if len(tile_positions) == 0:
+            return merged_image
+
+        # sigmoid(x) > threshold <=> x > logit(threshold), so the logits are compared directly
+        logit_threshold = np.log(class_threshold / (1 - class_threshold))
+
+        for batch_positions, tiles in self._iter_tile_batches(padded_img, tile_positions):
+            prediction = self._predict(tiles)
+            prediction = np.squeeze(prediction, axis=1)
+            self._stitch_batch(merged_image, prediction > logit_threshold, batch_positions)
+
+        return merged_image
+
+    def _get_text_region_tiles(
+            self, image: npt.NDArray, padded_img: npt.NDArray, pad_x: int, pad_y: int, class_threshold: float
+    ) -> npt.NDArray:
+        """
+        Runs the coarse pass and returns a boolean grid of the tiles of the padded page that overlap a text area
+        """
+        patch_size = self._patch_size
+        # the scale is relative to the clamped size of the page, not the size of the input image
+        content_h = padded_img.shape[0] - pad_y
+        content_w = padded_img.shape[1] - pad_x
+        coarse_size = (max(1, round(content_w * self._coarse_scale)), max(1, round(content_h * self._coarse_scale)))
+        coarse_img = cv2.resize(image, dsize=coarse_size, interpolation=cv2.INTER_AREA)
+
+        coarse_padded, coarse_pad_x, coarse_pad_y = self._preprocess_image(coarse_img, patch_size=patch_size)
+        coarse_prediction = self._predict_tiles(coarse_padded, self._get_ink_tiles(coarse_padded), class_threshold)
+        coarse_prediction = coarse_prediction[
+            :coarse_padded.shape[0] - coarse_pad_y, :coarse_padded.shape[1] - coarse_pad_x
+        ]
+
+        region_mask = get_text_regions(coarse_prediction)
+        region_mask = cv2.resize(region_mask, dsize=(content_w, content_h), interpolation=cv2.INTER_NEAREST)
+        region_mask = np.pad(region_mask, ((0, pad_y), (0, pad_x)))
+
+        y_steps = padded_img.shape[0] // patch_size
+        x_steps = padded_img.shape[1] // patch_size
+
+        return region_mask.reshape(y_steps, patch_size, x_steps, patch_size).any(axis=(1, 3))
+
+    def predict(self, image: npt.NDArray, class_threshold: float = 0.9) -> npt.NDArray | None:
+        """
+        Returns the line mask of the page, or None if the page is blank
+        """
+        padded_img, pad_x, pad_y = self._preprocess_image(image, patch_size=self._patch_size)
+        ink_tiles = self._get_ink_tiles(padded_img)
+
+        if len(ink_tiles) == 0:
+            return None
+
+        if self._coarse_scale is not None:
+            region_tiles = self._get_text_region_tiles(image, padded_img, pad_x, pad_y, class_threshold)
+            ink_tiles = [(y, x) for y, x in ink_tiles if region_tiles[y, x]]
+
+        merged_image = self._predict_tiles(padded_img, ink_tiles, class_threshold)
         merged_image = self._crop_prediction(image, merged_image, pad_x, pad_y)
-        merged_image = merged_image.astype(np.uint8)
         merged_image *= 255
 
         return merged_image
 
 
 class LayoutDetection(Detection):
-    def __init__(self, platform: Platform, config: LayoutDetectionConfig, debug: bool = False) -> None:
-        super().__init__(platform, config)
+    def __init__(
+            self,
+            platform: Platform,
+            config: LayoutDetectionConfig,
+            debug: bool = False,
+            memory_budget: int = 1024,
+            session_config: SessionConfig | None = None,
+            min_tile_ink: float = 0.0002
+    ) -> None:
+        super().__init__(platform, config, memory_budget, session_config=session_config, min_tile_ink=min_tile_ink)
         self._classes = config.classes
         self._debug = debug
 
@@ -161,10 +355,10 @@ class LayoutDetection(Detection):
         if image is None:
             return None
 
-        image_predictions = self._get_contours(prediction[:, :, 1])
-        line_predictions = self._get_contours(prediction[:, :, 2])
-        caption_predictions = self._get_contours(prediction[:, :, 3])
-        margin_predictions = self._get_contours(prediction[:, :, 4])
+        image_predictions = self._get_contours(cv2.compare(prediction, 1, cv2.CMP_EQ))
+        line_predictions = self._get_contours(cv2.compare(prediction, 2, cv2.CMP_EQ))
+        caption_predictions = self._get_contours(cv2.compare(prediction, 3, cv2.CMP_EQ))
+        margin_predictions = self._get_contours(cv2.compare(prediction, 4, cv2.CMP_EQ))
 
         mask = np.zeros(image.shape, dtype=np.uint8)
 
@@ -204,23 +398,71 @@ class LayoutDetection(Detection):
 
         return image
 
-    def predict(self, image: npt.NDArray, class_threshold: float = 0.8) -> npt.NDArray:
-        _, tiles, y_steps, pad_x, pad_y = self._preprocess_image(
-            image, patch_size=self._patch_size)
-        prediction = self._predict(tiles)
-        prediction = np.transpose(prediction, axes=[0, 2, 3, 1])
-        prediction = softmax(prediction, axis=-1)
-        prediction = np.where(prediction > class_threshold, 1.0, 0)
-        merged_image = stitch_predictions(prediction, y_steps=y_steps)
-        merged_image = self._crop_prediction(image, merged_image, pad_x, pad_y)
-        merged_image = merged_image.astype(np.uint8)
-        merged_image *= 255
+    @staticmethod
+    def _get_labels(prediction: npt.NDArray, class_threshold: float, classes: List[int]) -> npt.NDArray:
+        """
+        Labels the pixels of a batch of logits (N, C, H, W) whose softmax probability of one of the classes is above
+        the class_threshold. That is the case if sum(exp(z_j - z_c)) < (1 - threshold) / threshold over the other
+        classes j, which is only evaluated where the largest difference z_j - z_c doesn't decide it already.
+        """
+        n_classes = prediction.shape[1]
+        labels = np.zeros((prediction.shape[0], *prediction.shape[2:]), dtype=np.uint8)
+        odds_threshold = (1 - class_threshold) / class_threshold
+
+        for class_idx in classes:
+            other_classes = [x for x in range(n_classes) if x != class_idx]
+            logit_diffs = prediction[:, other_classes] - prediction[:, class_idx:class_idx + 1]
+            max_diff = logit_diffs.max(axis=1)
+
+            # each term of the sum is at most the largest one, and the sum at most n - 1 times the largest one
+            is_class = max_diff < np.log(odds_threshold / (n_classes - 1))
+            undecided = (max_diff < np.log(odds_threshold)) & ~is_class
+
+            if undecided.any():
+                undecided_diffs = np.moveaxis(logit_diffs, 1, -1)[undecided]
+                is_class[undecided] = np.exp(undecided_diffs).sum(axis=-1) < odds_threshold
+
+            labels[is_class] = class_idx
+
+        return labels
+
+    def predict(
+            self, image: npt.NDArray, class_threshold: float = 0.8, classes: List[int] | None = None
+    ) -> npt.NDArray | None:
+        """
+        Returns a label map of the page with the index of the class whose probability is above the class_threshold
+        for each pixel, or None if the page is blank. Only the given classes are labeled (by default all except the
+        background at index 0), all other pixels are 0. The class_threshold has to be at least 0.5, so that a pixel
+        can't belong to more than one class.
+        """
+        padded_img, pad_x, pad_y = self._preprocess_image(image, patch_size=self._patch_size)
+        ink_tiles = self._get_ink_tiles(padded_img)
+
+        if len(ink_tiles) == 0:
+            return None
+
+        if classes is None:
+            classes = list(range(1, self._output_channels))
+
+        merged_image = np.zeros(padded_img.shape[:2], dtype=np.uint8)
+
+        for tile_positions, tiles in self._iter_tile_batches(padded_img, ink_tiles):
+            prediction = self._predict(tiles)
+            self._stitch_batch(merged_image, self._get_labels(prediction, class_threshold, classes), tile_positions)
+
+        merged_image = self._crop_prediction(image, merged_image, pad_x, pad_y, labels=classes)
 
         return merged_image
 
 
 class OCRInference:
-    def __init__(self, platform: Platform, ocr_config: OCRModelConfig):
+    def __init__(
+            self,
+            platform: Platform,
+            ocr_config: OCRModelConfig,
+            width_step: int = 128,
+            session_config: SessionConfig | None = None
+    ):
         self.platform = platform
         self.config = ocr_config
         self._onnx_model_file = ocr_config.model_file
@@ -231,44 +473,92 @@ class OCRInference:
         self._characters = ocr_config.charset
         self._squeeze_channel_dim = ocr_config.squeeze_channel
         self._swap_hw = ocr_config.swap_hw
-        self._execution_providers = get_execution_providers()
-        self.ocr_session = ort.InferenceSession(
-            self._onnx_model_file, providers=self._execution_providers
-        )
+        self.ocr_session = get_inference_session(self._onnx_model_file, session_config)
         self._add_blank = ocr_config.add_blank
+        self._width_step = width_step
+        self._dynamic_width = self._has_dynamic_width()
         self.decoder = CTCDecoder(self._characters, self._add_blank)
+        self._time_major = self._has_time_major_logits()
+
+    def _has_dynamic_width(self) -> bool:
+        """
+        Checks whether the width axis of the model input is symbolic, i.e. the graph accepts line images of any width
+        """
+        width_axis = -2 if self._swap_hw else -1
+
+        for model_input in self.ocr_session.get_inputs():
+            if model_input.name == self._input_layer:
+                return not isinstance(model_input.shape[width_axis], int)
+
+        return False
+
+    def _has_time_major_logits(self) -> bool:
+        """
+        Checks whether the model returns the logits of a line as (time, vocab) or as (vocab, time). The layout is taken
+        from the output shape of the session, or from runs on a blank line if the shape does not tell the axes apart.
+        """
+        vocab_size = len(self.decoder.ctc_vocab)
+
+        for model_output in self.ocr_session.get_outputs():
+            if model_output.name == self._output_layer:
+                shape = model_output.shape[-2:]
+
+                if shape[1] == vocab_size and shape[0] != vocab_size:
+                    return True
+                if shape[0] == vocab_size and shape[1] != vocab_size:
+                    return False
+
+        # the time axis is the one that changes with the input width
+        widths = [self._input_width, self._input_width // 2] if self._dynamic_width else [self._input_width]
+        blank_line = np.full((self._input_height, self._input_height, 3), 255, dtype=np.uint8)
+        shapes = [self._predict(self._prepare_ocr_batch([blank_line], x)).shape[-2:] for x in widths]
+
+        if len(shapes) > 1 and shapes[0] != shapes[1]:
+            return shapes[0][0] != shapes[1][0]
+
+        if shapes[0][0] == vocab_size and shapes[0][1] == vocab_size:
+            logging.warning(f"Can't tell the time and vocab axes of the logits of {self._onnx_model_file} apart")
+
+        return shapes[0][0] != vocab_size
 
     def _pad_ocr_line(
             self,
             img: npt.NDArray,
             padding: str = "black",
+            target_width: int | None = None
     ) -> npt.NDArray:
 
-        width_ratio = self._input_width / img.shape[1]
+        if target_width is None:
+            target_width = self._input_width
+
+        width_ratio = target_width / img.shape[1]
         height_ratio = self._input_height / img.shape[0]
 
         if width_ratio < height_ratio:
-            out_img = pad_to_width(img, self._input_width, self._input_height, padding)
+            out_img = pad_to_width(img, target_width, self._input_height, padding)
 
         elif width_ratio > height_ratio:
-            out_img = pad_to_height(img, self._input_width, self._input_height, padding)
+            out_img = pad_to_height(img, target_width, self._input_height, padding)
         else:
-            out_img = pad_to_width(img, self._input_width, self._input_height, padding)
+            out_img = pad_to_width(img, target_width, self._input_height, padding)
 
         return cv2.resize(
             out_img,
-            (self._input_width, self._input_height),
+            (target_width, self._input_height),
             interpolation=cv2.INTER_LINEAR,
         )
 
-    def _prepare_ocr_line(self, image: npt.NDArray) -> npt.NDArray:
-        line_image = self._pad_ocr_line(image)
+    def _prepare_ocr_line(self, image: npt.NDArray, target_width: int | None = None) -> npt.NDArray:
+        if target_width is None:
+            target_width = self._input_width
+
+        line_image = self._pad_ocr_line(image, target_width=target_width)
         line_image = binarize(line_image)
 
         if len(line_image.shape) == 3:
             line_image = cv2.cvtColor(line_image, cv2.COLOR_RGB2GRAY)
 
-        line_image = line_image.reshape((1, self._input_height, self._input_width))
+        line_image = line_image.reshape((1, self._input_height, target_width))
         line_image = (line_image / 127.5) - 1.0
         line_image = line_image.astype(np.float32)
 
@@ -285,19 +575,18 @@ class OCRInference:
         return out_img
 
     def _predict(self, image_batch: npt.NDArray) -> npt.NDArray:
-        image_batch = image_batch.astype(np.float32)
+        image_batch = image_batch.astype(np.float32, copy=False)
         ort_batch = ort.OrtValue.ortvalue_from_numpy(image_batch)
         ocr_results = self.ocr_session.run_with_ort_values(
             [self._output_layer], {self._input_layer: ort_batch}
         )
 
         logits = ocr_results[0].numpy()
-        logits = np.squeeze(logits)
 
         return logits
 
     def _decode(self, logits: npt.NDArray) -> str:
-        if logits.shape[0] == len(self.decoder.ctc_vocab):
+        if not self._time_major:
             logits = np.transpose(
                 logits, axes=[1, 0]
             )  # adjust logits to have shape time, vocab
@@ -319,140 +608,425 @@ class OCRInference:
             line_image = np.expand_dims(line_image, axis=1)
 
         logits = self._predict(line_image)
+        logits = np.squeeze(logits)
         text = self._decode(logits)
 
         return text
 
+    def _get_width_buckets(self, line_images: List[npt.NDArray]) -> Dict[int, List[int]]:
+        """
+        Sorts the lines by aspect ratio and groups them by the input width they need at the model's input height,
+        rounded up to a multiple of the width step and capped at the configured input width.
+        """
+        if not self._dynamic_width:
+            return {self._input_width: list(range(len(line_images)))}
+
+        aspect_ratios = [x.shape[1] / x.shape[0] for x in line_images]
+        buckets = {}
+
+        for idx in np.argsort(aspect_ratios, kind="stable"):
+            natural_width = math.ceil(aspect_ratios[idx] * self._input_height)
+            bucket_width = math.ceil(natural_width / self._width_step) * self._width_step
+            bucket_width = min(bucket_width, self._input_width)
+            buckets.setdefault(bucket_width, []).append(int(idx))
+
+        return buckets
+
+    def _prepare_ocr_batch(self, line_images: List[npt.NDArray], target_width: int) -> npt.NDArray:
+        if self._swap_hw:
+            line_batch = np.empty((len(line_images), target_width, self._input_height), dtype=np.float32)
+        else:
+            line_batch = np.empty((len(line_images), self._input_height, target_width), dtype=np.float32)
+
+        for idx, line_image in enumerate(line_images):
+            line_image = self._prepare_ocr_line(line_image, target_width)
+
+            if self._swap_hw:
+                line_image = np.transpose(line_image, axes=[0, 2, 1])
+
+            line_batch[idx] = line_image[0]
+
+        if not self._squeeze_channel_dim:
+            line_batch = np.expand_dims(line_batch, axis=1)
+
+        return line_batch
+
+    def run_batch(
+            self,
+            line_images: List[npt.NDArray],
+            pre_pad: bool = True,
+            batch_size: int = 8,
+            beam_threshold: float = 0.8
+    ) -> Tuple[List[str], List[float]]:
+        """
+        Prepares the line images into preallocated (N, H, W) tensors and runs the recognition in chunks of batch_size,
+        which avoids paying the per-run overhead of the session for every single line of a page.
+        If the model accepts a dynamic input width, lines are bucketed by width so that short lines are not padded
+        out to the full input width.
+        Each chunk is decoded greedily at once, and only the lines whose confidence is below the beam_threshold are
+        decoded again with the beam search. A beam_threshold of 0 only decodes greedily.
+        Returns the texts and the confidences of the greedy decoding of the lines.
+        """
+        if len(line_images) == 0:
+            return [], []
+
+        if pre_pad:
+            line_images = [self._pre_pad(x) for x in line_images]
+
+        batch_size = max(1, batch_size)
+        texts = [""] * len(line_images)
+        confidences = [0.0] * len(line_images)
+
+        for bucket_width, indices in self._get_width_buckets(line_images).items():
+            line_batch = self._prepare_ocr_batch([line_images[x] for x in indices], bucket_width)
+
+            for start in range(0, len(indices), batch_size):
+                logits = self._predict(line_batch[start:start + batch_size])
+                logits = logits.reshape(logits.shape[0], *logits.shape[-2:])
+
+                if not self._time_major:
+                    logits = np.transpose(logits, axes=[0, 2, 1])  # adjust logits to have shape batch, time, vocab
+
+                batch_texts, batch_confidences = self.decoder.greedy_decode(logits)
+
+                for idx, line_logits, text, confidence in zip(
+                        indices[start:start + batch_size], logits, batch_texts, batch_confidences
+                ):
+                    if confidence < beam_threshold:
+                        text = self.decoder.ctc_decode(line_logits)
+
+                    texts[idx] = text
+                    confidences[idx] = float(confidence)
+
+        return texts, confidences
+
 
 class OCRPipeline:
     """
     Note: The handling of line model vs. layout model is kind of provisional here and totally depends on the way you want to run this.
     You could also pass both configs to the pipeline, run both models and merge the (partially) overlapping output before extracting the line images to compensate for the strengths/weaknesses
     of either model. So that is basically up to you.
+
+    The intermediates of the last max_page_states pages are kept, so that rerunning a page with other settings (e.g.
+    in the GUI) starts where the settings diverge. Batch runs never revisit a page and keep none.
     """
 
     def __init__(
             self,
             platform: Platform,
             ocr_config: OCRModelConfig,
-            line_config: LineDetectionConfig | LayoutDetectionConfig
+            line_config: LineDetectionConfig | LayoutDetectionConfig,
+            memory_budget: int = 1024,
+            session_config: SessionConfig | None = None,
+            detection_cache: DetectionCache | None = None,
+            max_page_states: int = 8,
+            angle_epsilon: float = 0.1,
+            rotate_mask: bool = True,
+            coarse_scale: float | None = None
     ):
         self.ready = False
         self.platform = platform
         self.ocr_model_config = ocr_config
         self.line_config = line_config
+        self.memory_budget = memory_budget
+        self.session_config = session_config
+        self.detection_cache = detection_cache
+        self.max_page_states = max_page_states
+        self.angle_epsilon = angle_epsilon
+        self.rotate_mask = rotate_mask
+        self.coarse_scale = coarse_scale
+        self._page_states: OrderedDict[str, PageState] = OrderedDict()
+        self._page_states_lock = threading.Lock()
         self.encoder = ocr_config.encoder
-        self.ocr_inference = OCRInference(self.platform, self.ocr_model_config)
+        self.ocr_inference = OCRInference(self.platform, self.ocr_model_config, session_config=self.session_config)
         self.converter = pyewts.pyewts()
-
-        if isinstance(self.line_config, LineDetectionConfig):
-            self.line_inference = LineDetection(self.platform, self.line_config)
-            self.ready = True
-        elif isinstance(self.line_config, LayoutDetectionConfig):
-            self.line_inference = LayoutDetection(self.platform, self.line_config)
-            self.ready = True
+        self.line_inference = self._build_line_inference(self.line_config)
+        self.ready = self.line_inference is not None
+
+    def _build_line_inference(
+            self, config: Union[LineDetectionConfig, LayoutDetectionConfig]
+    ) -> LineDetection | LayoutDetection | None:
+        if isinstance(config, LineDetectionConfig):
+            return LineDetection(
+                self.platform,
+                config,
+                memory_budget=self.memory_budget,
+                session_config=self.session_config,
+                coarse_scale=self.coarse_scale
+            )
+        elif isinstance(config, LayoutDetectionConfig):
+            return LayoutDetection(
+                self.platform, config, memory_budget=self.memory_budget, session_config=self.session_config
+            )
         else:
-            self.line_inference = None
-            self.ready = False
+            return None
 
     def update_ocr_model(self, config: OCRModelConfig):
         self.ocr_model_config = config
-        self.ocr_inference = OCRInference(self.platform, config)
+        self.encoder = config.encoder
+        self.ocr_inference = OCRInference(self.platform, config, session_config=self.session_config)
 
     def update_line_detection(self, config: Union[LineDetectionConfig, LayoutDetectionConfig]):
-        if isinstance(config, LineDetectionConfig) and isinstance(self.line_config, LayoutDetectionConfig):
-            self.line_inference = LineDetection(self.platform, config)
-        elif isinstance(config, LayoutDetectionConfig) and isinstance(self.line_config, LineDetectionConfig):
-            self.line_inference = LayoutDetection(self.platform, config)
+        line_inference = self._build_line_inference(config)
 
-        else:
+        if line_inference is None:
             return
 
+        self.line_config = config
+        self.line_inference = line_inference
+        self.ready = True
+        self.clear_page_states()
 
-    # TODO: Generate specific meaningful error codes that can be returned inbetween the steps
-    # TPS Mode is global-only at the moment
-    def run_ocr(self,
-                image: npt.NDArray,
-                k_factor: float = 2.5,
-                bbox_tolerance: float = 4.0,
-                merge_lines: bool = True,
-                use_tps: bool = False,
-                tps_mode: TPSMode = TPSMode.GLOBAL,
-                tps_threshold: float = 0.25,
-                target_encoding: Encoding = Encoding.Unicode
-                ):
 
+    def detect_lines(self, image: npt.NDArray) -> npt.NDArray | None:
+        """
+        Returns the line mask of the page, or None if the page is blank
+        """
         if isinstance(self.line_config, LineDetectionConfig):
             line_mask = self.line_inference.predict(image)
+        else:
+            layout_labels = self.line_inference.predict(image, classes=[2])
+            line_mask = cv2.compare(layout_labels, 2, cv2.CMP_EQ) if layout_labels is not None else None
+
+        return line_mask
+
+    def detect_page(self, image: npt.NDArray, image_digest: str | None = None) -> LineDetectionResult:
+        """
+        Runs the line detection and returns the rotated line mask, the line contours and the page angle. These are
+        taken from the detection cache if the page was already run with the current line or layout model.
+        """
+        cache_key = None
+
+        if self.detection_cache is not None:
+            if image_digest is None:
+                image_digest = get_image_digest(image)
 
+            cache_key = self.detection_cache.build_key(image_digest, self.line_config, self.get_detection_settings())
+            detection = self.detection_cache.get(cache_key)
+
+            if detection is not None:
+                return detection
+
+        line_mask = self.detect_lines(image)
+
+        if line_mask is not None:
+            rot_mask, line_contours, page_angle = build_line_mask_data(line_mask, self.angle_epsilon, self.rotate_mask)
+            detection = LineDetectionResult(rot_mask=rot_mask, line_contours=line_contours, angle=page_angle)
         else:
-            layout_mask = self.line_inference.predict(image)
-            line_mask = layout_mask[:, :, 2]
+            rot_mask = np.zeros((image.shape[0], image.shape[1], 3), dtype=np.uint8)
+            detection = LineDetectionResult(rot_mask=rot_mask, line_contours=[], angle=0.0, blank=True)
+
+        if cache_key is not None:
+            self.detection_cache.put(cache_key, detection)
+
+        return detection
+
+    def get_detection_settings(self) -> Dict:
+        """
+        Returns the settings the pipeline was built with that change the line detection, for the keys of the caches
+        """
+        return self.build_detection_settings(self.angle_epsilon, self.rotate_mask, self.coarse_scale)
 
-        rot_img, rot_mask, line_contours, page_angle = build_raw_line_data(image, line_mask)
+    @staticmethod
+    def build_detection_settings(
+            angle_epsilon: float = 0.1, rotate_mask: bool = True, coarse_scale: float | None = None
+    ) -> Dict:
+        """
+        Returns the detection settings of a pipeline built with these arguments, e.g. for keying the cache of pages
+        that are run on a process pool
+        """
+        return {"angle_epsilon": angle_epsilon, "rotate_mask": rotate_mask, "coarse_scale": coarse_scale}
 
-        if len(line_contours) == 0:
-            return OpStatus.FAILED, None
+    def get_page_state(self, image: npt.NDArray) -> PageState:
+        """
+        Returns the intermediates of a page, running the line detection if the page is not among the recently
+        processed pages
+        """
+        image_digest = get_image_digest(image)
+
+        with self._page_states_lock:
+            state = self._page_states.get(image_digest)
 
-        filtered_contours = filter_line_contours(rot_mask, line_contours)
+            if state is not None:
+                self._page_states.move_to_end(image_digest)
+                return state
 
-        if len(filtered_contours) == 0:
-            return OpStatus.FAILED, None
+        # the page is not rotated here, the line extraction rotates only the regions of the lines if they are sparse
+        detection = self.detect_page(image, image_digest)
 
-        if use_tps:
-            ratio, tps_line_data = check_for_tps(rot_img, filtered_contours)
+        if len(detection.line_contours) > 0:
+            filtered_contours = filter_line_contours(detection.rot_mask, detection.line_contours)
+        else:
+            filtered_contours = []
 
-            if ratio > tps_threshold:
-                    dewarped_img, dewarped_mask = apply_global_tps(rot_img, rot_mask, tps_line_data)
+        state = PageState(detection=detection, image=image, filtered_contours=filtered_contours)
+
+        with self._page_states_lock:
+            self._page_states[image_digest] = state
+
+            while len(self._page_states) > self.max_page_states:
+                self._page_states.popitem(last=False)
+
+        return state
+
+    def clear_page_states(self):
+        with self._page_states_lock:
+            self._page_states.clear()
+
+    def extract_lines(
+            self,
+            state: PageState,
+            k_factor: float = 2.5,
+            bbox_tolerance: float = 4.0,
+            merge_lines: bool = True,
+            use_tps: bool = False,
+            tps_mode: TPSMode = TPSMode.GLOBAL,
+            tps_threshold: float = 0.25
+    ) -> bool:
+        """
+        Updates the sorted lines and the line images of a page. Only the steps whose arguments changed since the last
+        run on this page are run again. Returns False if the page has no lines.
+        The global tps mode dewarps the whole page if the ratio of curved lines exceeds the tps_threshold, the local
+        mode dewarps each curved line within its own region.
+        """
+        if len(state.filtered_contours) == 0:
+            return False
+
+        with state.lock:
+            dewarp = False
+            # the local mode dewarps the curved lines one by one during the line extraction
+            local_tps = use_tps and tps_mode == TPSMode.LOCAL
+
+            if use_tps and not local_tps:
+                if state.tps_check is None:
+                    state.tps_check = check_for_tps(state.image, state.filtered_contours)
+
+                ratio, tps_line_data = state.tps_check
+                dewarp = ratio > tps_threshold
+
+                if dewarp and state.dewarped is None:
+                    rot_img = rotate_from_angle(state.image, state.detection.angle)
+                    dewarped_img, dewarped_mask = apply_global_tps(rot_img, state.detection.rot_mask, tps_line_data)
 
                     if len(dewarped_mask.shape) == 3:
                         dewarped_mask = cv2.cvtColor(dewarped_mask, cv2.COLOR_RGB2GRAY)
 
                     # get new raw line information, rotation angle etc. from the dewarped page
-                    dew_rot_img, dew_rot_mask, line_contours, page_angle = build_raw_line_data(dewarped_img,
-                                                                                               dewarped_mask)
+                    dew_rot_img, dew_rot_mask, line_contours, dew_angle = build_raw_line_data(dewarped_img,
+                                                                                              dewarped_mask)
                     filtered_contours = filter_line_contours(dew_rot_mask, line_contours)
+                    state.dewarped = dew_rot_img, filtered_contours, dew_angle
 
-                    line_data = [build_line_data(x) for x in filtered_contours]
-                    sorted_lines, _ = sort_lines_by_threshold2(rot_mask, line_data, group_lines=merge_lines)
-                    line_images = extract_line_images(dew_rot_img, sorted_lines, k_factor, bbox_tolerance)
-
+            if dewarp:
+                page_img, line_contours, page_angle = state.dewarped
+                # the dewarped page is already rotated
+                extract_angle = 0.0
             else:
-                line_data = [build_line_data(x) for x in filtered_contours]
-                sorted_lines, _ = sort_lines_by_threshold2(rot_mask, line_data, group_lines=merge_lines)
-                line_images = extract_line_images(rot_img, sorted_lines, k_factor, bbox_tolerance)
-        else:
-            line_data = [build_line_data(x) for x in filtered_contours]
+                page_img, line_contours, page_angle = state.image, state.filtered_contours, state.detection.angle
+                extract_angle = page_angle
+
+            sort_args = (dewarp, merge_lines)
 
-            sorted_lines, _ = sort_lines_by_threshold2(
-                rot_mask, line_data, group_lines=merge_lines
+            if state.sort_args != sort_args:
+                line_data = [build_line_data(x) for x in line_contours]
+                state.sorted_lines, _ = sort_lines_by_threshold2(
+                    state.detection.rot_mask, line_data, group_lines=merge_lines
+                )
+                state.page_angle = page_angle
+                state.sort_args = sort_args
+                state.local_tps_check = None
+                state.extract_args = None
+
+            extract_args = sort_args + (local_tps, k_factor, bbox_tolerance)
+
+            if state.extract_args != extract_args:
+                if local_tps:
+                    if state.local_tps_check is None:
+                        state.local_tps_check = [check_line_tps(x.contour) for x in state.sorted_lines]
+
+                    state.line_images = get_line_images_via_local_tps(
+                        page_img, state.sorted_lines, state.local_tps_check, k_factor, bbox_tolerance, extract_angle
+                    )
+                else:
+                    state.line_images = extract_line_images(
+                        page_img, state.sorted_lines, k_factor, bbox_tolerance, extract_angle
+                    )
+                state.extract_args = extract_args
+                state.recognition_args = None
+
+        return state.line_images is not None and len(state.line_images) > 0
+
+    def recognize_lines(
+            self,
+            state: PageState,
+            target_encoding: Encoding = Encoding.Unicode,
+            batch_size: int = 8,
+            beam_threshold: float = 0.8
+    ) -> List[OCRLine]:
+        with state.lock:
+            recognition_args = (
+                self.ocr_model_config.model_file, self.ocr_model_config.version, state.extract_args, beam_threshold
             )
 
-            line_images = extract_line_images(rot_img, sorted_lines, k_factor, bbox_tolerance)
+            if state.recognition_args != recognition_args:
+                state.predictions, state.confidences = self.ocr_inference.run_batch(
+                    state.line_images, batch_size=batch_size, beam_threshold=beam_threshold
+                )
+                state.recognition_args = recognition_args
 
-        if line_images is not None and len(line_images) > 0:
-            page_text = []
-            ocr_lines = []
+            predictions, confidences, lines = state.predictions, state.confidences, state.sorted_lines
 
-            for line_img, line_info in zip(line_images, sorted_lines):
-                pred = self.ocr_inference.run(line_img)
-                pred = pred.strip()
-                pred = pred.replace("§", " ")
+        ocr_lines = []
 
-                if self.encoder == CharsetEncoder.Wylie and target_encoding == Encoding.Unicode:
-                    pred = self.converter.toUnicode(pred)
+        for pred, confidence, line_info in zip(predictions, confidences, lines):
+            pred = pred.strip()
+            pred = pred.replace("§", " ")
 
-                elif self.encoder == CharsetEncoder.Stack and target_encoding == Encoding.Wylie:
-                    pred = self.converter.toWylie(pred)
+            if self.encoder == CharsetEncoder.Wylie and target_encoding == Encoding.Unicode:
+                pred = self.converter.toUnicode(pred)
 
-                ocr_line = OCRLine(
-                    guid=line_info.guid,
-                    text=pred,
-                    encoding=Encoding.Wylie if target_encoding == Encoding.Wylie else Encoding.Unicode
-                )
-                ocr_lines.append(ocr_line)
-                page_text.append(pred)
+            elif self.encoder == CharsetEncoder.Stack and target_encoding == Encoding.Wylie:
+                pred = self.converter.toWylie(pred)
 
-            return OpStatus.SUCCESS, (rot_mask, sorted_lines, ocr_lines, page_angle)
-        else:
-            return OpStatus.FAILED, None
+            ocr_line = OCRLine(
+                guid=line_info.guid,
+                text=pred,
+                encoding=Encoding.Wylie if target_encoding == Encoding.Wylie else Encoding.Unicode,
+                confidence=confidence
+            )
+            ocr_lines.append(ocr_line)
+
+        return ocr_lines
+
+    @staticmethod
+    def get_failure(state: PageState) -> OCRFailure:
+        """
+        Returns the reason why a page without line images failed
+        """
+        return OCRFailure.BlankPage if state.detection.blank else OCRFailure.NoLines
+
+    def run_ocr(self,
+                image: npt.NDArray,
+                k_factor: float = 2.5,
+                bbox_tolerance: float = 4.0,
+                merge_lines: bool = True,
+                use_tps: bool = False,
+                tps_mode: TPSMode = TPSMode.GLOBAL,
+                tps_threshold: float = 0.25,
+                target_encoding: Encoding = Encoding.Unicode,
+                batch_size: int = 8,
+                beam_threshold: float = 0.8
+                ):
+        """
+        Returns the status and either the rotated line mask, the sorted lines, the ocr lines and the page angle or,
+        if the OCR failed, the OCRFailure
+        """
+        state = self.get_page_state(image)
+
+        with state.lock:
+            if not self.extract_lines(state, k_factor, bbox_tolerance, merge_lines, use_tps, tps_mode, tps_threshold):
+                return OpStatus.FAILED, self.get_failure(state)
+
+            ocr_lines = self.recognize_lines(state, target_encoding, batch_size, beam_threshold)
+
+            return OpStatus.SUCCESS, (state.detection.rot_mask, state.sorted_lines, ocr_lines, state.page_angle)
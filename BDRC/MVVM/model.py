@@ -6,7 +6,8 @@ import numpy.typing as npt
 from uuid import UUID
 from glob import glob
 from typing import List, Dict
-from BDRC.Utils import create_dir, import_local_models
+from BDRC.Utils import create_dir, import_local_models, read_line_model_config, read_layout_model_config, \
+    read_ocr_settings
 from BDRC.Data import (
     AppSettings,
     Encoding,
@@ -54,6 +55,9 @@ class SettingsModel:
         self.tmp_dir = os.path.join(self.user_directory, "tmp")
         create_dir(self.tmp_dir)
 
+        self.ocr_cache_dir = os.path.join(self.user_directory, "cache", "ocr")
+        self.detection_cache_dir = os.path.join(self.user_directory, "cache", "detection")
+
         if os.path.isdir(self.app_settings.model_path):
             try:
                 ocr_models = import_local_models(self.app_settings.model_path)
@@ -138,29 +142,7 @@ class SettingsModel:
             theme=THEMES[_theme]
         )
 
-        file = open(ocr_settings_file, encoding="utf-8")
-        ocr_json_settings = json.loads(file.read())
-        _line_mode = ocr_json_settings["line_mode"]
-        _line_merge = ocr_json_settings["line_merge"]
-        _line_sorting = ocr_json_settings["line_sorting"]
-        _k_factor = ocr_json_settings["k_factor"]
-        _bbox_tolerance = ocr_json_settings["bbox_tolerance"]
-        _dewarping = ocr_json_settings["dewarp"]
-        _merge_lines = ocr_json_settings["merge_lines"]
-        _tps = ocr_json_settings["tps"]
-        _out_encoding = ocr_json_settings["output_encoding"]
-
-        ocr_settings = OCRSettings(
-            line_mode=LINE_MODES[_line_mode],
-            line_merge=LINE_MERGE[_line_merge],
-            line_sorting=LINE_SORTING[_line_sorting],
-            dewarping=True if _dewarping == "yes" else False,
-            merge_lines=True if _merge_lines == "yes" else False,
-            k_factor=float(_k_factor),
-            bbox_tolerance=float(_bbox_tolerance),
-            tps_mode=TPS_MODE[_tps],
-            output_encoding=ENCODINGS[_out_encoding],
-        )
+        ocr_settings = read_ocr_settings(ocr_settings_file)
 
         return app_settings, ocr_settings
   
@@ -207,31 +189,10 @@ class SettingsModel:
             json.dump(_settings, f, ensure_ascii=False, indent=1)
 
     def read_line_model_config(self, target_dir: str) -> LineDetectionConfig:
-        target_file = os.path.join(target_dir, "config.json")
-        model_dir = os.path.dirname(target_file)
-        file = open(target_file, encoding="utf-8")
-        json_content = json.loads(file.read())
-
-        onnx_model_file = f"{model_dir}/{json_content['onnx-model']}"
-        patch_size = int(json_content["patch_size"])
-
-        config = LineDetectionConfig(onnx_model_file, patch_size)
-
-        return config
+        return read_line_model_config(target_dir)
     
     def read_layout_model_config(self, target_dir: str) -> LayoutDetectionConfig:
-        target_file = os.path.join(target_dir, "config.json")
-        model_dir = os.path.dirname(target_file)
-        file = open(target_file, encoding="utf-8")
-        json_content = json.loads(file.read())
-
-        onnx_model_file = f"{model_dir}/{json_content['onnx-model']}"
-        patch_size = int(json_content["patch_size"])
-        classes = json_content["classes"]
-
-        config = LayoutDetectionConfig(onnx_model_file, patch_size, classes)
-
-        return config
+        return read_layout_model_config(target_dir)
 
 
 class OCRDataModel:
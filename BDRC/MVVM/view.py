@@ -7,9 +7,12 @@ from PySide6.QtCore import Signal, Qt, QThreadPool
 from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QSplitter, QLabel
 
 from BDRC.Styles import DARK
+from BDRC.Batch import SharedOCRProcessPool
+from BDRC.Cache import DetectionCache, OCRResultCache
 from BDRC.Inference import OCRPipeline
-from BDRC.Data import OpStatus, Platform, OCRData, OCRModel, OCResult
-from BDRC.Utils import build_ocr_data, get_filename, create_dir
+from BDRC.Data import OCRFailure, OpStatus, Platform, OCRData, OCRModel, OCResult
+from BDRC.Utils import get_filename, create_dir
+from BDRC.QtUtils import build_ocr_data
 from BDRC.Widgets.Dialogs import NotificationDialog, SettingsDialog, BatchOCRDialog, ExportDialog, \
     ImportImagesDialog, ImportPDFDialog, ImportFilesProgress
 from BDRC.Widgets.Layout import HeaderTools, ImageGallery, Canvas, TextView
@@ -127,6 +130,10 @@ class AppView(QWidget):
         self._settingsview_model = settingsview_model
 
         self.tmp_dir = self._settingsview_model.get_tmp_dir()
+        self.ocr_cache = OCRResultCache(self._settingsview_model.get_ocr_cache_dir())
+        self.detection_cache = DetectionCache(self._settingsview_model.get_detection_cache_dir())
+        # the workers of the batch OCR are kept alive between batches and shut down with the app
+        self.process_pool = SharedOCRProcessPool()
         self.resource_dir = self._settingsview_model.get_execution_dir()
 
         self.image_gallery = ImageGallery(self._dataview_model, self.threadpool, self.resource_dir)
@@ -164,7 +171,8 @@ class AppView(QWidget):
             self.ocr_pipeline = OCRPipeline(
                 self.platform,
                 ocr_model.config,
-                line_config)
+                line_config,
+                detection_cache=self.detection_cache)
         else:
             self.ocr_pipeline = None
 
@@ -294,19 +302,39 @@ class AppView(QWidget):
         data = self._dataview_model.get_data_by_guid(guid)
 
         if os.path.isfile(data.image_path):
-            img = cv2.imread(data.image_path)
             ocr_settings = self._settingsview_model.get_ocr_settings()
-            status, result = self.ocr_pipeline.run_ocr(
-                img,
-                k_factor=ocr_settings.k_factor,
-                bbox_tolerance=ocr_settings.bbox_tolerance,
-                merge_lines=ocr_settings.merge_lines,
-                use_tps=ocr_settings.dewarping)
+            ocr_args = {
+                "k_factor": ocr_settings.k_factor,
+                "bbox_tolerance": ocr_settings.bbox_tolerance,
+                "merge_lines": ocr_settings.merge_lines,
+                "use_tps": ocr_settings.dewarping,
+                "tps_mode": ocr_settings.tps_mode
+            }
+            cache_key = self.ocr_cache.build_key(
+                data.image_path,
+                self.ocr_pipeline.ocr_model_config,
+                self.ocr_pipeline.line_config,
+                ocr_args,
+                self.ocr_pipeline.get_detection_settings()
+            )
+            result = self.ocr_cache.get(cache_key)
+
+            if result is not None:
+                status = OpStatus.SUCCESS
+            else:
+                img = cv2.imread(data.image_path)
+                status, result = self.ocr_pipeline.run_ocr(img, **ocr_args)
+
+                if status == OpStatus.SUCCESS:
+                    self.ocr_cache.put(cache_key, result)
 
             if status == OpStatus.SUCCESS:
                 mask, line_data, page_text, angle = result
                 self._dataview_model.update_ocr_data(guid, page_text)
                 self._dataview_model.update_page_data(guid, line_data, mask, angle)
+            elif result == OCRFailure.BlankPage:
+                dialog = NotificationDialog("Failed Running OCR", "The selected image is a blank page.")
+                dialog.exec()
             else:
                 dialog = NotificationDialog("Failed Running OCR", "Failed to run OCR on selected image.")
                 dialog.exec()
@@ -324,7 +352,9 @@ class AppView(QWidget):
                 ocr_pipeline=self.ocr_pipeline,
                 ocr_models=self._settingsview_model.get_ocr_models(),
                 ocr_settings=self._settingsview_model.get_ocr_settings(),
-                threadpool=self.threadpool
+                threadpool=self.threadpool,
+                ocr_cache=self.ocr_cache,
+                process_pool=self.process_pool
             )
             batch_dialog.sign_ocr_result.connect(self.update_ocr_result)
 
@@ -374,4 +404,11 @@ class AppView(QWidget):
             self.ocr_pipeline.update_ocr_model(ocr_model.config)
         else:
             line_model_config = self._settingsview_model.get_line_model()
-            self.ocr_pipeline = OCRPipeline(self.platform, ocr_model.config, line_model_config)
+            self.ocr_pipeline = OCRPipeline(
+                self.platform, ocr_model.config, line_model_config, detection_cache=self.detection_cache
+            )
+
+    def closeEvent(self, event):
+        # pages that are still running are not waited for
+        self.process_pool.shutdown(wait=False)
+        super().closeEvent(event)
@@ -19,6 +19,12 @@ class SettingsViewModel(QObject):
     def get_tmp_dir(self):
         return self._model.tmp_dir
 
+    def get_ocr_cache_dir(self) -> str:
+        return self._model.ocr_cache_dir
+
+    def get_detection_cache_dir(self) -> str:
+        return self._model.detection_cache_dir
+
     def get_execution_dir(self) -> str:
         return self._model.execution_directory
     
@@ -0,0 +1,52 @@
+from PySide6.QtGui import QImage
+from PySide6.QtWidgets import QApplication
+
+from BDRC.Data import OCRData, ScreenData
+from BDRC.Utils import generate_guid, get_filename
+
+"""
+Helpers that depend on Qt. These are kept apart from BDRC.Utils so that the OCR pipeline can be imported without PySide6.
+"""
+
+
+def get_screen_center(app: QApplication, start_size_ratio: float = 0.8) -> ScreenData:
+    screen = app.primaryScreen()
+    rect = screen.availableGeometry()
+    max_width = rect.width()
+    max_height = rect.height()
+
+    start_width = int(rect.width() * start_size_ratio)
+    start_height = int(rect.height() * start_size_ratio)
+
+    start_pos_x = (max_width - start_width) // 2
+    start_pos_y = (max_height - start_height) // 2
+
+    screen_data = ScreenData(
+        max_width=max_width,
+        max_height=max_height,
+        start_width=start_width,
+        start_height=start_height,
+        start_x=start_pos_x,
+        start_y=start_pos_y,
+    )
+
+    return screen_data
+
+
+def build_ocr_data(tick: int, file_path: str, target_height: int):
+    file_name = get_filename(file_path)
+    guid = generate_guid(tick)
+    q_image = QImage(file_path).scaledToHeight(target_height)
+    
+    ocr_data = OCRData(
+        guid=guid,
+        image_path=file_path,
+        image_name=file_name,
+        qimage=q_image,
+        ocr_lines=None,
+        lines=None,
+        preview=None,
+        angle=0.0
+    )
+
+    return ocr_data
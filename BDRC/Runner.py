@@ -1,10 +1,14 @@
+import os
 import cv2
 from uuid import UUID
-from typing import List
+from typing import Dict, List
 from PySide6.QtCore import QObject, Signal, QRunnable
 
+from BDRC.Batch import SharedOCRProcessPool
+from BDRC.Cache import OCRResultCache, run_cached
 from BDRC.Inference import OCRPipeline
-from BDRC.Data import OpStatus, OCResult, LineMode, OCRData, Encoding, OCRSettings, OCRSample
+from BDRC.Stages import StagedOCRPipeline
+from BDRC.Data import OpStatus, OCResult, LineMode, OCRData, Encoding, OCRSettings, OCRSample, TPSMode
 
 
 
@@ -52,10 +56,14 @@ class OCRBatchRunner(QRunnable):
             ocr_pipeline: OCRPipeline,
             mode: LineMode = LineMode.Layout,
             dewarp: bool = True,
+            tps_mode: TPSMode = TPSMode.GLOBAL,
             merge_lines: bool = True,
             k_factor: float = 1.7,
             bbox_tolerance: float = 3.0,
-            target_encoding: Encoding = Encoding.Unicode
+            target_encoding: Encoding = Encoding.Unicode,
+            workers: int = 1,
+            cache: OCRResultCache | None = None,
+            process_pool: SharedOCRProcessPool | None = None
             ):
 
         super(OCRBatchRunner, self).__init__()
@@ -65,10 +73,16 @@ class OCRBatchRunner(QRunnable):
         self.data = data
         self.mode = mode
         self.do_dewarp = dewarp
+        self.tps_mode = tps_mode
         self.merge_lines = merge_lines
         self.k_factor = k_factor
         self.bbox_tolerance = bbox_tolerance
         self.target_encoding = target_encoding
+        self.workers = workers
+        self.cache = cache
+        # without a shared pool, the pool is only kept for this batch
+        self.owns_process_pool = process_pool is None
+        self.process_pool = process_pool if process_pool is not None else SharedOCRProcessPool()
         self.stop = False
 
     def kill(self):
@@ -76,41 +90,86 @@ class OCRBatchRunner(QRunnable):
         self.stop = True
 
     def run(self):
-        results = {}
-
-        for idx, data in enumerate(self.data):
-            if not self.stop:
-                img = cv2.imread(data.image_path)
-                status, result = self.ocr_pipeline.run_ocr(
-                    image=img,
-                    k_factor=self.k_factor,
-                    bbox_tolerance=self.bbox_tolerance,
-                    merge_lines=self.merge_lines,
-                    use_tps=self.do_dewarp,
-                    target_encoding=self.target_encoding
-                )
-
-                if status == OpStatus.SUCCESS:
-                    rot_mask, lines, ocr_lines, angle = result
-
-                    ocr_result = OCResult(
-                        guid=data.guid,
-                        mask=rot_mask,
-                        lines=lines,
-                        text=ocr_lines,
-                        angle=angle
-                    )
-                    results[data.guid] = ocr_result
-                    sample = OCRSample(
-                        cnt=idx,
-                        guid=data.guid,
-                        name=data.image_name,
-                        result=ocr_result
-                    )
-                    self.signals.sample.emit(sample)
-            else:
-                self.signals.finished.emit()
+        image_paths = [x.image_path for x in self.data]
+        ocr_args = {
+            "k_factor": self.k_factor,
+            "bbox_tolerance": self.bbox_tolerance,
+            "merge_lines": self.merge_lines,
+            "use_tps": self.do_dewarp,
+            "tps_mode": self.tps_mode,
+            "target_encoding": self.target_encoding
+        }
+
+        if self.cache is not None:
+            keys = [
+                self.cache.build_key(
+                    x,
+                    self.ocr_pipeline.ocr_model_config,
+                    self.ocr_pipeline.line_config,
+                    ocr_args,
+                    self.ocr_pipeline.get_detection_settings()
+                ) if os.path.isfile(x) else None for x in image_paths
+            ]
+            results = run_cached(self.cache, image_paths, keys, lambda paths: self.run_pages(paths, ocr_args))
+        else:
+            results = self.run_pages(image_paths, ocr_args)
+
+        try:
+            for idx, status, result in results:
+                if self.stop:
+                    break
+                self.emit_sample(idx, self.data[idx], status, result)
+        finally:
+            if self.owns_process_pool:
+                self.process_pool.shutdown(wait=not self.stop)
 
         self.signals.finished.emit()
 
+    def run_pages(self, image_paths: List[str], ocr_args: Dict):
+        if self.workers > 1 and len(image_paths) > 1:
+            yield from self.run_parallel(image_paths, ocr_args)
+        else:
+            yield from self.run_sequential(image_paths, ocr_args)
+
+    def run_sequential(self, image_paths: List[str], ocr_args: Dict):
+        staged_pipeline = StagedOCRPipeline(self.ocr_pipeline)
+        yield from staged_pipeline.run(image_paths, **ocr_args, should_stop=lambda: self.stop)
+
+    def run_parallel(self, image_paths: List[str], ocr_args: Dict):
+        detection_cache = self.ocr_pipeline.detection_cache
+        # the workers are started on demand, so a small batch does not start all of them
+        pool = self.process_pool.get(
+            self.ocr_pipeline.platform,
+            self.ocr_pipeline.ocr_model_config,
+            self.ocr_pipeline.line_config,
+            workers=self.workers,
+            memory_budget=self.ocr_pipeline.memory_budget,
+            detection_cache_dir=detection_cache.cache_dir if detection_cache is not None else None,
+            coarse_scale=self.ocr_pipeline.coarse_scale
+        )
+
+        try:
+            yield from pool.run(image_paths, **ocr_args, should_stop=lambda: self.stop)
+        finally:
+            if self.stop:
+                # pages that are still running after a kill are not waited for, the next batch starts a new pool
+                self.process_pool.shutdown(wait=False)
+
+    def emit_sample(self, idx: int, data: OCRData, status: OpStatus, result):
+        if status == OpStatus.SUCCESS:
+            rot_mask, lines, ocr_lines, angle = result
 
+            ocr_result = OCResult(
+                guid=data.guid,
+                mask=rot_mask,
+                lines=lines,
+                text=ocr_lines,
+                angle=angle
+            )
+            sample = OCRSample(
+                cnt=idx,
+                guid=data.guid,
+                name=data.image_name,
+                result=ocr_result
+            )
+            self.signals.sample.emit(sample)
@@ -0,0 +1,206 @@
+import os
+import json
+import glob
+import hashlib
+import logging
+import threading
+import onnxruntime as ort
+from pathlib import Path
+from typing import Dict, Tuple
+
+from BDRC.Data import ExecutionMode, OptimizationLevel, SessionConfig
+from BDRC.Utils import create_dir, get_execution_providers
+
+"""
+A process-wide registry of onnxruntime sessions, so that switching back and forth between models or
+recreating the pipeline reuses the already loaded sessions instead of reading and optimizing the models again.
+Sessions are keyed by the model file, its modification time and the session options.
+
+If a model cache directory is set, the graphs optimized by onnxruntime are written to that directory on the first load
+and used on later loads. The cached files are invalidated by the hash of the source model, the onnxruntime version,
+the optimization level and the available execution providers.
+Note: The cached graphs are saved with at most the extended optimizations, since the layout optimizations of
+ORT_ENABLE_ALL are hardware specific. Those are applied again when the cached graph is loaded.
+"""
+
+OPTIMIZATION_LEVELS = {
+    OptimizationLevel.Disabled: ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    OptimizationLevel.Basic: ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    OptimizationLevel.Extended: ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    OptimizationLevel.All: ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+}
+
+EXECUTION_MODES = {
+    ExecutionMode.Sequential: ort.ExecutionMode.ORT_SEQUENTIAL,
+    ExecutionMode.Parallel: ort.ExecutionMode.ORT_PARALLEL
+}
+
+_sessions: Dict[Tuple[str, float, SessionConfig], ort.InferenceSession] = {}
+_sessions_lock = threading.Lock()
+_model_cache_dir: str | None = None
+
+
+def set_model_cache_dir(cache_dir: str | None) -> None:
+    global _model_cache_dir
+
+    if cache_dir is not None:
+        create_dir(cache_dir)
+        create_dir(os.path.join(cache_dir, "index"))
+
+    _model_cache_dir = cache_dir
+
+
+def get_model_cache_dir() -> str | None:
+    return _model_cache_dir
+
+
+def build_session_options(config: SessionConfig) -> ort.SessionOptions:
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = config.intra_op_threads
+    options.inter_op_num_threads = config.inter_op_threads
+    options.graph_optimization_level = OPTIMIZATION_LEVELS[config.optimization_level]
+    options.execution_mode = EXECUTION_MODES[config.execution_mode]
+
+    return options
+
+
+def get_file_hash(file_path: str) -> str:
+    """
+    Returns the sha256 of a file. The hashes are memoized in the model cache by path, size and modification time, so
+    that large models are not read again on every start. Each file has its own index entry, which is replaced
+    atomically, so that the worker processes of a pool can't lose each other's entries or read a half-written one.
+    """
+    stat = os.stat(file_path)
+    index_dir = os.path.join(_model_cache_dir, "index")
+    index_file = os.path.join(index_dir, f"{hashlib.sha256(file_path.encode('utf-8')).hexdigest()[:16]}.json")
+    entry = None
+
+    try:
+        with open(index_file, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (IOError, ValueError) as e:
+        logging.warning(f"Failed to read model cache index entry {index_file}: {e}")
+
+    if (
+            isinstance(entry, dict)
+            and entry.get("path") == file_path
+            and entry.get("size") == stat.st_size
+            and entry.get("mtime") == stat.st_mtime_ns
+            and "sha256" in entry
+    ):
+        return entry["sha256"]
+
+    file_hash = hashlib.sha256()
+
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+
+    entry = {"path": file_path, "size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": file_hash.hexdigest()}
+    tmp_index_file = f"{index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        with open(tmp_index_file, "w", encoding="utf-8") as f:
+            json.dump(entry, f, indent=1)
+        os.replace(tmp_index_file, index_file)
+    except IOError as e:
+        logging.warning(f"Failed to write model cache index entry {index_file}: {e}")
+
+    return entry["sha256"]
+
+
+def get_cached_model_file(model_file: str, config: SessionConfig, providers: list[str]) -> Tuple[str, str]:
+    """
+    Returns the path of the cached optimized graph for a model and the prefix shared by all cached versions of it
+    """
+    path_hash = hashlib.sha256(model_file.encode("utf-8")).hexdigest()[:8]
+    cache_key = ":".join([
+        get_file_hash(model_file),
+        ort.__version__,
+        ",".join(providers)
+    ])
+    cache_key = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()[:16]
+    level = config.optimization_level.name.lower()
+    prefix = os.path.join(_model_cache_dir, f"{Path(model_file).stem}_{path_hash}_{level}")
+
+    return f"{prefix}_{cache_key}.onnx", prefix
+
+
+def create_cached_session(model_file: str, config: SessionConfig, providers: list[str]) -> ort.InferenceSession:
+    cached_file, prefix = get_cached_model_file(model_file, config, providers)
+    options = build_session_options(config)
+
+    if os.path.isfile(cached_file):
+        if config.optimization_level != OptimizationLevel.All:
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+
+        try:
+            return ort.InferenceSession(cached_file, sess_options=options, providers=providers)
+        except Exception as e:
+            logging.warning(f"Failed to load cached model {cached_file}, rebuilding it: {e}")
+
+            try:
+                os.remove(cached_file)
+            except OSError:
+                # another worker may have removed it already
+                pass
+
+            options = build_session_options(config)
+
+    for stale_file in glob.glob(f"{prefix}_*.onnx"):
+        try:
+            os.remove(stale_file)
+        except OSError:
+            pass
+
+    if config.optimization_level == OptimizationLevel.All:
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+
+    # writing to a temporary file first since several worker processes may be loading the same model
+    tmp_file = f"{cached_file}.{os.getpid()}.tmp"
+    options.optimized_model_filepath = tmp_file
+    session = ort.InferenceSession(model_file, sess_options=options, providers=providers)
+
+    try:
+        os.replace(tmp_file, cached_file)
+    except OSError as e:
+        logging.warning(f"Failed to write cached model {cached_file}: {e}")
+        return session
+
+    if config.optimization_level == OptimizationLevel.All:
+        session = ort.InferenceSession(cached_file, sess_options=build_session_options(config), providers=providers)
+
+    return session
+
+
+def get_inference_session(model_file: str, config: SessionConfig | None = None) -> ort.InferenceSession:
+    if config is None:
+        config = SessionConfig()
+
+    model_file = os.path.abspath(model_file)
+    key = (model_file, os.path.getmtime(model_file), config)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+
+        if session is None:
+            providers = get_execution_providers()
+
+            if _model_cache_dir is not None and config.optimization_level != OptimizationLevel.Disabled:
+                session = create_cached_session(model_file, config, providers)
+            else:
+                session = ort.InferenceSession(
+                    model_file,
+                    sess_options=build_session_options(config),
+                    providers=providers
+                )
+            _sessions[key] = session
+
+    return session
+
+
+def clear_sessions() -> None:
+    with _sessions_lock:
+        _sessions.clear()
@@ -0,0 +1,225 @@
+import cv2
+import queue
+import logging
+import threading
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from BDRC.Data import Encoding, OCRFailure, OpStatus, TPSMode
+from BDRC.Inference import OCRPipeline
+
+"""
+Streams a sequence of pages through the stages of an OCRPipeline (decode -> detect -> extract -> recognize), each stage
+running on its own threads with bounded queues in between. Since onnxruntime and most of OpenCV release the GIL, the
+image decoding and line extraction of the next pages overlap with the inference of the current one.
+"""
+
+_STOP = object()
+
+
+class _Stage:
+    """
+    Runs a function on the items of the input queue on n threads and puts the results into the output queue.
+    The last thread of a stage to finish passes the end of the stream on to the next stage.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            func: Callable,
+            workers: int,
+            input_queue: queue.Queue,
+            output_queue: queue.Queue,
+            next_workers: int,
+            stop_event: threading.Event
+    ):
+        self.name = name
+        self.func = func
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.next_workers = next_workers
+        self.stop_event = stop_event
+        self.running = workers
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True) for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = _get(self.input_queue, self.stop_event)
+
+            if item is _STOP:
+                break
+
+            idx, data = item
+
+            try:
+                # a failed page is passed on as its OCRFailure, so that the following stages keep the order of the stream
+                result = self.func(data) if not isinstance(data, OCRFailure) else data
+            except Exception as e:
+                logging.error(f"Failed to run stage '{self.name}' on page {idx}: {e}")
+                result = OCRFailure.Error
+
+            if not _put(self.output_queue, (idx, result), self.stop_event):
+                break
+
+        with self.lock:
+            self.running -= 1
+            is_last = self.running == 0
+
+        if is_last:
+            for _ in range(self.next_workers):
+                _put(self.output_queue, _STOP, self.stop_event)
+
+
+def _get(q: queue.Queue, stop_event: threading.Event):
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+    return _STOP
+
+
+def _put(q: queue.Queue, item, stop_event: threading.Event) -> bool:
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+class StagedOCRPipeline:
+    """
+    Runs the OCR of a list of images as a stream of stages on a shared OCRPipeline, e.g.:
+
+        staged = StagedOCRPipeline(pipeline, extract_workers=2)
+        for idx, status, result in staged.run(image_paths, k_factor=2.0):
+            ...
+
+    The results are yielded in the order of the images with the same status and result as OCRPipeline.run_ocr.
+    """
+
+    def __init__(
+            self,
+            pipeline: OCRPipeline,
+            decode_workers: int = 1,
+            detect_workers: int = 1,
+            extract_workers: int = 2,
+            recognize_workers: int = 1,
+            queue_size: int = 4
+    ):
+        self.pipeline = pipeline
+        self.decode_workers = decode_workers
+        self.detect_workers = detect_workers
+        self.extract_workers = extract_workers
+        self.recognize_workers = recognize_workers
+        self.queue_size = queue_size
+
+    def run(
+            self,
+            image_paths: List[str],
+            k_factor: float = 2.5,
+            bbox_tolerance: float = 4.0,
+            merge_lines: bool = True,
+            use_tps: bool = False,
+            tps_mode: TPSMode = TPSMode.GLOBAL,
+            tps_threshold: float = 0.25,
+            target_encoding: Encoding = Encoding.Unicode,
+            batch_size: int = 8,
+            beam_threshold: float = 0.8,
+            should_stop: Callable[[], bool] | None = None
+    ) -> Iterator[Tuple[int, OpStatus, Tuple | None]]:
+
+        def decode(image_path: str):
+            image = cv2.imread(image_path)
+
+            return image if image is not None else OCRFailure.ImageNotReadable
+
+        def detect(image):
+            return self.pipeline.get_page_state(image)
+
+        def extract(state):
+            has_lines = self.pipeline.extract_lines(
+                state, k_factor, bbox_tolerance, merge_lines, use_tps, tps_mode, tps_threshold
+            )
+            return state if has_lines else self.pipeline.get_failure(state)
+
+        def recognize(state):
+            with state.lock:
+                ocr_lines = self.pipeline.recognize_lines(state, target_encoding, batch_size, beam_threshold)
+
+                return state.detection.rot_mask, state.sorted_lines, ocr_lines, state.page_angle
+
+        stop_event = threading.Event()
+        stages = [
+            ("decode", decode, self.decode_workers),
+            ("detect", detect, self.detect_workers),
+            ("extract", extract, self.extract_workers),
+            ("recognize", recognize, self.recognize_workers)
+        ]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+        stage_runners = []
+
+        for i, (name, func, workers) in enumerate(stages):
+            next_workers = stages[i + 1][2] if i + 1 < len(stages) else 1
+            stage_runners.append(_Stage(name, func, workers, queues[i], queues[i + 1], next_workers, stop_event))
+
+        def feed():
+            for item in enumerate(image_paths):
+                if not _put(queues[0], item, stop_event):
+                    return
+
+            for _ in range(self.decode_workers):
+                _put(queues[0], _STOP, stop_event)
+
+        feeder = threading.Thread(target=feed, name="feed", daemon=True)
+        feeder.start()
+
+        for stage in stage_runners:
+            stage.start()
+
+        # the stages finish pages out of order when running on several threads
+        finished: Dict[int, Tuple | None] = {}
+        next_idx = 0
+
+        try:
+            while next_idx < len(image_paths):
+                if should_stop is not None and should_stop():
+                    break
+
+                item = _get(queues[-1], stop_event)
+
+                if item is _STOP:
+                    break
+
+                idx, result = item
+                finished[idx] = result
+
+                while next_idx in finished:
+                    result = finished.pop(next_idx)
+
+                    if isinstance(result, OCRFailure):
+                        yield next_idx, OpStatus.FAILED, result
+                    else:
+                        yield next_idx, OpStatus.SUCCESS, result
+
+                    next_idx += 1
+        finally:
+            stop_event.set()
+            feeder.join()
+
+            for stage in stage_runners:
+                stage.join()
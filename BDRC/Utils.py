@@ -2,7 +2,6 @@ import os
 import cv2
 import json
 import math
-import scipy
 import logging
 import platform
 import numpy as np
@@ -13,15 +12,12 @@ from math import ceil
 from uuid import uuid1
 from pathlib import Path
 from datetime import datetime
-from tps import ThinPlateSpline
 from typing import List, Tuple, Optional, Sequence
 
-from BDRC.Data import OCRModelConfig, Platform, ScreenData, BBox, Line, \
-    OCRModel, OCRData
-from PySide6.QtWidgets import QApplication
-from PySide6.QtGui import QImage
+from BDRC.Data import OCRModelConfig, Platform, BBox, Line, OCRModel, OCRSettings, \
+    LineDetectionConfig, LayoutDetectionConfig
 
-from Config import OCRARCHITECTURE, CHARSETENCODER
+from Config import OCRARCHITECTURE, CHARSETENCODER, ENCODINGS, LINE_MERGE, LINE_MODES, LINE_SORTING, TPS_MODE
 
 page_classes = {
                 "background": "0, 0, 0",
@@ -31,30 +27,6 @@ page_classes = {
                 "caption": "255, 100, 243"
             }
 
-def get_screen_center(app: QApplication, start_size_ratio: float = 0.8) -> ScreenData:
-    screen = app.primaryScreen()
-    rect = screen.availableGeometry()
-    max_width = rect.width()
-    max_height = rect.height()
-
-    start_width = int(rect.width() * start_size_ratio)
-    start_height = int(rect.height() * start_size_ratio)
-
-    start_pos_x = (max_width - start_width) // 2
-    start_pos_y = (max_height - start_height) // 2
-
-    screen_data = ScreenData(
-        max_width=max_width,
-        max_height=max_height,
-        start_width=start_width,
-        start_height=start_height,
-        start_x=start_pos_x,
-        start_y=start_pos_y,
-    )
-
-    return screen_data
-
-
 def get_platform() -> Platform:
     _platform_tag = platform.platform()
     _platform_tag = _platform_tag.split("-")[0]
@@ -99,24 +71,6 @@ def generate_guid(clock_seq: int):
     return uuid1(clock_seq=clock_seq)
 
 
-def build_ocr_data(tick: int, file_path: str, target_height: int):
-    file_name = get_filename(file_path)
-    guid = generate_guid(tick)
-    q_image = QImage(file_path).scaledToHeight(target_height)
-    
-    ocr_data = OCRData(
-        guid=guid,
-        image_path=file_path,
-        image_name=file_name,
-        qimage=q_image,
-        ocr_lines=None,
-        lines=None,
-        preview=None,
-        angle=0.0
-    )
-
-    return ocr_data
-
 def read_theme_file(file_path: str) -> dict | None:
     if os.path.isfile(file_path):
         with open(file_path, "r") as f:
@@ -191,6 +145,87 @@ def read_ocr_model_config(config_file: str):
     return config
 
 
+def read_line_model_config(target_dir: str) -> LineDetectionConfig:
+    target_file = os.path.join(target_dir, "config.json")
+    model_dir = os.path.dirname(target_file)
+    file = open(target_file, encoding="utf-8")
+    json_content = json.loads(file.read())
+
+    onnx_model_file = f"{model_dir}/{json_content['onnx-model']}"
+    patch_size = int(json_content["patch_size"])
+
+    config = LineDetectionConfig(onnx_model_file, patch_size)
+
+    return config
+
+
+def read_layout_model_config(target_dir: str) -> LayoutDetectionConfig:
+    target_file = os.path.join(target_dir, "config.json")
+    model_dir = os.path.dirname(target_file)
+    file = open(target_file, encoding="utf-8")
+    json_content = json.loads(file.read())
+
+    onnx_model_file = f"{model_dir}/{json_content['onnx-model']}"
+    patch_size = int(json_content["patch_size"])
+    classes = json_content["classes"]
+
+    config = LayoutDetectionConfig(onnx_model_file, patch_size, classes)
+
+    return config
+
+
+def read_ocr_settings(settings_file: str) -> OCRSettings:
+    file = open(settings_file, encoding="utf-8")
+    ocr_json_settings = json.loads(file.read())
+    _line_mode = ocr_json_settings["line_mode"]
+    _line_merge = ocr_json_settings["line_merge"]
+    _line_sorting = ocr_json_settings["line_sorting"]
+    _k_factor = ocr_json_settings["k_factor"]
+    _bbox_tolerance = ocr_json_settings["bbox_tolerance"]
+    _dewarping = ocr_json_settings["dewarp"]
+    _merge_lines = ocr_json_settings["merge_lines"]
+    _tps = ocr_json_settings["tps"]
+    _out_encoding = ocr_json_settings["output_encoding"]
+
+    ocr_settings = OCRSettings(
+        line_mode=LINE_MODES[_line_mode],
+        line_merge=LINE_MERGE[_line_merge],
+        line_sorting=LINE_SORTING[_line_sorting],
+        dewarping=True if _dewarping == "yes" else False,
+        merge_lines=True if _merge_lines == "yes" else False,
+        k_factor=float(_k_factor),
+        bbox_tolerance=float(_bbox_tolerance),
+        tps_mode=TPS_MODE[_tps],
+        output_encoding=ENCODINGS[_out_encoding],
+    )
+
+    return ocr_settings
+
+
+def extract_pdf_images(file_path: str, target_dir: str) -> List[str]:
+    """
+    Writes the first embedded image of each page of a PDF file to target_dir and returns the paths of the written files
+    """
+    from pypdf import PdfReader
+
+    file_n = get_filename(file_path)
+    reader = PdfReader(file_path)
+    image_paths = []
+    create_dir(target_dir)
+
+    for idx, page in enumerate(reader.pages):
+        if len(page.images) > 0:
+            data = page.images[0].data
+            tmp_img_path = f"{target_dir}/{file_n}_{idx}.jpg"
+
+            with open(str(tmp_img_path), "wb") as f:
+                f.write(data)
+
+            image_paths.append(tmp_img_path)
+
+    return image_paths
+
+
 def resize_to_height(image, target_height: int):
     scale_ratio = target_height / image.shape[0]
     image = cv2.resize(
@@ -253,19 +288,28 @@ def sigmoid(x):
     return 1 / (1 + np.exp(-x))
 
 
-def run_tps(image: npt.NDArray, input_pts, output_pts, add_corners=True, alpha=0.5):
-
-    if len(image.shape) == 3:
-        height, width, _ = image.shape
-    else:
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-        height, width, _ = image.shape
+def get_tps_maps(
+        height: int,
+        width: int,
+        input_pts,
+        output_pts,
+        add_corners: bool = True,
+        alpha: float = 0.5,
+        grid_step: int = 16
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """
+    Fits a thin plate spline to the control points, given as (y, x), and returns the maps for cv2.remap.
+    The spline is only evaluated on a coarse grid of every grid_step-th pixel. The displacement it describes is smooth,
+    so it is upscaled to the full page by linear interpolation, and the maps can be reused for all images of that size.
+    """
+    # imported here since the spline pulls in scipy.spatial, which is slow to import and only needed for dewarping
+    from tps import ThinPlateSpline
 
-    input_pts = npt.NDArray(input_pts)
-    output_pts = npt.NDArray(output_pts)
+    input_pts = np.array(input_pts, dtype=np.float64)
+    output_pts = np.array(output_pts, dtype=np.float64)
 
     if add_corners:
-        corners = npt.NDArray(  # Add corners ctrl points
+        corners = np.array(  # Add corners ctrl points
         [
             [0.0, 0.0],
             [1.0, 0.0],
@@ -273,7 +317,6 @@ def run_tps(image: npt.NDArray, input_pts, output_pts, add_corners=True, alpha=0
             [1.0, 1.0],
         ])
 
-        corners *= [height, width]
         corners *= [height, width]
 
         input_pts = np.concatenate((input_pts, corners))
@@ -282,52 +325,88 @@ def run_tps(image: npt.NDArray, input_pts, output_pts, add_corners=True, alpha=0
     tps = ThinPlateSpline(alpha)
     tps.fit(input_pts, output_pts)
 
-    output_indices = np.indices((height, width), dtype=np.float64).transpose(1, 2, 0)  # Shape: (H, W, 2)
-    input_indices = tps.transform(output_indices.reshape(-1, 2)).reshape(height, width, 2)
-    warped = np.concatenate(
-        [
-            scipy.ndimage.map_coordinates(image[..., channel], input_indices.transpose(2, 0, 1))[..., None]
-            for channel in (0, 1, 2)
-        ],
-        axis=-1,
+    grid_h = ceil(height / grid_step)
+    grid_w = ceil(width / grid_step)
+
+    # the grid points are placed where cv2.resize puts the source pixels when upscaling by grid_step
+    grid_y = (np.arange(grid_h) + 0.5) * grid_step - 0.5
+    grid_x = (np.arange(grid_w) + 0.5) * grid_step - 0.5
+    grid = np.stack(np.meshgrid(grid_y, grid_x, indexing="ij"), axis=-1)  # Shape: (H, W, 2)
+
+    displacement = tps.transform(grid.reshape(-1, 2)).reshape(grid_h, grid_w, 2) - grid
+    displacement = cv2.resize(
+        displacement.astype(np.float32),
+        (grid_w * grid_step, grid_h * grid_step),
+        interpolation=cv2.INTER_LINEAR
+    )[:height, :width]
+
+    map_y = displacement[..., 0] + np.arange(height, dtype=np.float32)[:, None]
+    map_x = displacement[..., 1] + np.arange(width, dtype=np.float32)[None, :]
+
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+
+def remap_tps(image: npt.NDArray, tps_maps: Tuple[npt.NDArray, npt.NDArray], interpolation=cv2.INTER_LINEAR):
+    map_1, map_2 = tps_maps
+
+    return cv2.remap(
+        image, map_1, map_2, interpolation=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0
     )
 
-    return warped
 
-def get_line_images_via_local_tps(image: npt.NDArray, line_data: list, k_factor: float = 1.7):
-    default_k_factor = k_factor
-    current_k = default_k_factor
-    line_images = []
+def run_tps(image: npt.NDArray, input_pts, output_pts, add_corners=True, alpha=0.5):
+    height, width = image.shape[:2]
+    tps_maps = get_tps_maps(height, width, input_pts, output_pts, add_corners, alpha)
 
-    for line in line_data:
-        if line["tps"] is True:
-            output_pts = line["output_pts"]
-            input_pts = line["input_pts"]
+    return remap_tps(image, tps_maps)
 
-            assert input_pts is not None and output_pts is not None
 
-            tmp_mask = np.zeros((image.shape[0], image.shape[1]), dtype=np.uint8)
-            cv2.drawContours(tmp_mask, [line["contour"]], -1, (255, 255, 255), -1)
+def get_line_images_via_local_tps(
+        image: npt.NDArray,
+        line_data: List[Line],
+        tps_line_data: List[Tuple],
+        default_k: float = 1.7,
+        bbox_tolerance: float = 3,
+        angle: float = 0.0
+) -> List[npt.NDArray]:
+    """
+    Extracts the line images like extract_line_images, but dewarps each curved line within its own region first.
+    tps_line_data holds the result of check_line_tps for each line. Straight lines are extracted as they are, so the
+    cost of the dewarping scales with the area of the curved lines instead of the page.
+    """
+    image, angle = get_line_source(image, line_data, default_k, angle)
+    current_k = default_k
+    line_images = []
 
-            warped_img = run_tps(image, output_pts, input_pts)
-            warped_mask = run_tps(tmp_mask, output_pts, input_pts)
+    for line, (tps_status, input_pts, output_pts, _) in zip(line_data, tps_line_data):
+        bbox = cv2.boundingRect(line.contour)
+        h = bbox[3]
 
-            _, _, _, bbox_h = cv2.boundingRect(line["contour"])
+        x0, y0, x1, y1 = get_line_roi(bbox, image.shape, h, get_min_k_factor(h, current_k))
+        line_region = crop_rotated_region(image, angle, (x0, y0, x1, y1))
+        tmp_mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.drawContours(tmp_mask, [line.contour], -1, (255, 255, 255), -1, offset=(-x0, -y0))
 
-            line_img, adapted_k = get_line_image(warped_img, warped_mask, bbox_h, bbox_tolerance=2.0,
-                                                 k_factor=current_k)
-            line_images.append(line_img)
+        if tps_status:
+            # the control points are (y, x) in page coordinates
+            roi_offset = [y0, x0]
+            tps_maps = get_tps_maps(
+                y1 - y0, x1 - x0, np.subtract(output_pts, roi_offset), np.subtract(input_pts, roi_offset)
+            )
+            line_region = remap_tps(line_region, tps_maps)
+            tmp_mask = remap_tps(tmp_mask, tps_maps, interpolation=cv2.INTER_NEAREST)
 
-            if current_k != adapted_k:
-                current_k = adapted_k
+            # the straightened line is lower than its curved bbox
+            _, _, _, dewarped_h = cv2.boundingRect(tmp_mask)
+            h = dewarped_h if dewarped_h > 0 else h
 
-        else:
-            tmp_mask = np.zeros((image.shape[0], image.shape[1]), dtype=np.uint8)
-            cv2.drawContours(tmp_mask, [line["contour"]], -1, (255, 255, 255), -1)
+        line_img, adapted_k = get_line_image(
+            line_region, tmp_mask, h, bbox_tolerance=bbox_tolerance, k_factor=current_k
+        )
+        line_images.append(line_img)
 
-            _, _, _, h = cv2.boundingRect(line["contour"])
-            line_img, adapted_k = get_line_image(image, tmp_mask, h, bbox_tolerance=2.0, k_factor=current_k)
-            line_images.append(line_img)
+        if current_k != adapted_k:
+            current_k = adapted_k
 
     return line_images
 
@@ -366,6 +445,25 @@ def get_text_area(
     else:
         return None, None, None
 
+
+def get_text_regions(prediction: npt.NDArray, margin: int = 16) -> npt.NDArray:
+    """
+    Returns a mask of the text areas of a line prediction, i.e. the bounding boxes of the dilated line blocks as in
+    get_text_area, widened by margin. Unlike get_text_area, all areas are kept instead of only the biggest one, e.g.
+    the columns of a page or the captions next to an illustration.
+    """
+    dil_kernel = np.ones((12, 2))
+    dil_prediction = cv2.dilate(prediction, kernel=dil_kernel, iterations=10)
+    contours, _ = cv2.findContours(dil_prediction, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    region_mask = np.zeros(prediction.shape[:2], dtype=np.uint8)
+
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        cv2.rectangle(region_mask, (x - margin, y - margin), (x + w + margin, y + h + margin), 255, -1)
+
+    return region_mask
+
 def get_text_bbox(lines: List[Line]):
     all_bboxes = [x.bbox for x in lines]
     min_x = min(a.x for a in all_bboxes)
@@ -424,22 +522,82 @@ def calculate_rotation_angle_from_lines(
     return mean_angle
 
 
+def get_rotation_matrix(image_shape: Tuple, angle: float) -> npt.NDArray:
+    rows, cols = image_shape[:2]
+
+    return cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
+
+
 def rotate_from_angle(image: np.array, angle: float) -> np.array:
+    if angle == 0:
+        return image
+
     rows, cols = image.shape[:2]
-    rot_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
+    rot_matrix = get_rotation_matrix(image.shape, angle)
 
     rotated_img = cv2.warpAffine(image, rot_matrix, (cols, rows), borderValue=(0, 0, 0))
 
     return rotated_img
 
 
+def rotate_line_contours(line_contours: Sequence[npt.NDArray], image_shape: Tuple, angle: float) -> List[npt.NDArray]:
+    """
+    Maps contours of an image to the same image rotated by rotate_from_angle. Like the pixels, the contours are
+    clipped to the image.
+    """
+    if angle == 0:
+        return list(line_contours)
+
+    if len(line_contours) == 0:
+        return []
+
+    rows, cols = image_shape[:2]
+    rot_matrix = get_rotation_matrix(image_shape, angle)
+
+    # transforming the points of all contours at once
+    points = np.concatenate(line_contours).astype(np.float64)
+    points = np.rint(cv2.transform(points, rot_matrix))
+    points = np.clip(points, 0, [cols - 1, rows - 1]).astype(np.int32)
+    contour_ends = np.cumsum([len(x) for x in line_contours])[:-1]
+
+    return np.split(points, contour_ends)
+
+
+def crop_rotated_region(image: npt.NDArray, angle: float, roi: Tuple[int, int, int, int]) -> npt.NDArray:
+    """
+    Returns the region (x0, y0, x1, y1) of the image rotated by rotate_from_angle, warping only that region.
+    The result matches the same crop of the rotated page within interpolation rounding: warpAffine snaps the source
+    positions to 1/32 px, and the shifted translation can snap them to the neighbouring step. This changes a small
+    fraction of the pixels by a few levels, up to about 10 on noisy images.
+    """
+    x0, y0, x1, y1 = roi
+
+    if angle == 0:
+        return image[y0:y1, x0:x1]
+
+    rot_matrix = get_rotation_matrix(image.shape, angle)
+    rot_matrix[:, 2] -= (x0, y0)
+
+    return cv2.warpAffine(image, rot_matrix, (x1 - x0, y1 - y0), borderValue=(0, 0, 0))
+
+
 def get_rotation_angle_from_lines(
     line_mask: npt.NDArray,
     max_angle: float = 5.0,
     debug_angles: bool = False,
 ) -> float:
     contours, _ = cv2.findContours(line_mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-    mask_threshold = (line_mask.shape[0] * line_mask.shape[1]) * 0.001
+
+    return get_rotation_angle_from_contours(contours, line_mask.shape, max_angle, debug_angles)
+
+
+def get_rotation_angle_from_contours(
+    contours: Sequence[npt.NDArray],
+    image_shape: Tuple,
+    max_angle: float = 5.0,
+    debug_angles: bool = False,
+) -> float:
+    mask_threshold = (image_shape[0] * image_shape[1]) * 0.001
     contours = [x for x in contours if cv2.contourArea(x) > mask_threshold]
     angles = [cv2.minAreaRect(x)[2] for x in contours]
 
@@ -575,6 +733,9 @@ def get_line_threshold(line_prediction: npt.NDArray, slice_width: int = 20):
     The slice with the max. number of contained contours is taken to be the canditate to calculate the bbox center of each contour and
     take the median distance between each bbox center as estimated line cut-off threshold to sort each line segment across the horizontal
 
+    The slices are evenly spaced, so they are taken as one strided view of the mask and placed side by side with an
+    empty column in between, which gives the contours of all slices in a single findContours call.
+
     Note: This approach might turn out to be problematic in case of sparsely spread line segments across a page
     """
 
@@ -584,96 +745,99 @@ def get_line_threshold(line_prediction: npt.NDArray, slice_width: int = 20):
     x, y, w, h = cv2.boundingRect(line_prediction)
     x_steps = (w // slice_width) // 2
 
-    bbox_numbers = []
+    if x_steps == 0:
+        return 0.0
 
-    for step in range(1, x_steps + 1):
-        x_offset = x_steps * step
-        x_start = x + x_offset
-        x_end = x_start + slice_width
+    x_start = x + x_steps
+    n_slices = min(x_steps, (line_prediction.shape[1] - x_start - 1) // x_steps + 1)
 
-        _slice = line_prediction[y : y + h, x_start:x_end]
-        contours, _ = cv2.findContours(_slice, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        bbox_numbers.append((len(contours), contours))
+    if n_slices <= 0:
+        return 0.0
 
-    sorted_list = sorted(bbox_numbers, key=lambda x: x[0], reverse=True)
+    line_area = line_prediction[y : y + h, x_start:]
+    overflow = x_steps * (n_slices - 1) + slice_width - line_area.shape[1]
 
-    if len(sorted_list) > 0:
-        reference_slice = sorted_list[0]
+    if overflow > 0:
+        # the last slice is cut off by the image border
+        line_area = np.pad(line_area, ((0, 0), (0, overflow)))
 
-        y_points = []
-        n_contours, contours = reference_slice
+    slices = np.lib.stride_tricks.as_strided(
+        line_area,
+        shape=(h, n_slices, slice_width),
+        strides=(line_area.strides[0], x_steps * line_area.strides[1], line_area.strides[1]),
+        writeable=False
+    )
+    slice_stack = np.zeros((h, n_slices, slice_width + 1), dtype=np.uint8)
+    slice_stack[:, :, :slice_width] = slices
+    slice_stack = slice_stack.reshape(h, n_slices * (slice_width + 1))
 
-        if n_contours == 0:
-            print("number of contours is 0")
-            line_threshold = 0.0
-        else:
-            for _, contour in enumerate(contours):
-                x, y, w, h = cv2.boundingRect(contour)
-                y_center = y + (h // 2)
-                y_points.append(y_center)
+    contours, _ = cv2.findContours(slice_stack, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
 
-            line_threshold = float(np.median(y_points) // n_contours)
-    else:
-        line_threshold = 0.0
+    if len(contours) == 0:
+        print("number of contours is 0")
+        return 0.0
+
+    bboxes = np.array([cv2.boundingRect(x) for x in contours]).reshape(-1, 4)
+    contour_slices = bboxes[:, 0] // (slice_width + 1)
+    n_lines = np.bincount(contour_slices, minlength=n_slices)
+
+    # the first slice with the max. number of contours
+    reference_slice = int(np.argmax(n_lines))
+    n_contours = int(n_lines[reference_slice])
+
+    reference_bboxes = bboxes[contour_slices == reference_slice]
+    y_points = reference_bboxes[:, 1] + (reference_bboxes[:, 3] // 2)
+
+    line_threshold = float(np.median(y_points) // n_contours)
 
     return line_threshold
 
 
-def sort_bbox_centers(bbox_centers: List[Tuple[int, int]], line_threshold: int = 20) -> List:
-    sorted_bbox_centers = []
-    tmp_line = []
-
-    for i in range(0, len(bbox_centers)):
-        if len(tmp_line) > 0:
-            for s in range(0, len(tmp_line)):
-
-                # TODO: refactor this to make this calculation an enum to choose between both methods
-                # y_diff = abs(tmp_line[s][1] - bbox_centers[i][1])
-                """
-                I use the mean of the hitherto present line chunks in tmp_line since
-                the precalculated fixed threshold can break the sorting if
-                there is some slight bending in the line. This part may need some tweaking after
-                some further practical review
-                """
-                ys = [y[1] for y in tmp_line]
-                mean_y = np.mean(ys)
-                y_diff = abs(mean_y - bbox_centers[i][1])
-
-                if y_diff > line_threshold:
-                    tmp_line.sort(key=lambda x: x[0])
-                    sorted_bbox_centers.append(tmp_line.copy())
-                    tmp_line.clear()
-
-                    tmp_line.append(bbox_centers[i])
-                    break
-                else:
-                    tmp_line.append(bbox_centers[i])
-                    break
+def sort_line_indices(bbox_centers: List[Tuple[int, int]], line_threshold: float = 20) -> List[List[int]]:
+    """
+    Groups the line chunks into lines and returns the indices of the chunks per line, bottom line first and each line
+    sorted from left to right. A chunk starts a new line if its center is further than line_threshold away from the
+    mean y of the chunks in the current line. The mean is kept as running sum, since the precalculated fixed threshold
+    can break the sorting if there is some slight bending in the line.
+    """
+    if len(bbox_centers) == 0:
+        return [[]]
+
+    centers = np.array(bbox_centers, dtype=np.int64).reshape(-1, 2)
+    line_groups = []
+    line_start = 0
+    y_sum = centers[0, 1]
+
+    for i in range(1, len(centers)):
+        mean_y = y_sum / (i - line_start)
+
+        if abs(mean_y - centers[i, 1]) > line_threshold:
+            line_groups.append(np.arange(line_start, i))
+            line_start = i
+            y_sum = centers[i, 1]
         else:
-            tmp_line.append(bbox_centers[i])
+            y_sum += centers[i, 1]
 
-    sorted_bbox_centers.append(tmp_line)
+    line_groups.append(np.arange(line_start, len(centers)))
 
-    for y in sorted_bbox_centers:
-        y.sort(key=lambda x: x[0])
+    # stable sort by x, so chunks with the same x keep their order
+    line_groups = [group[np.argsort(centers[group, 0], kind="stable")].tolist() for group in line_groups]
 
-    sorted_bbox_centers = list(reversed(sorted_bbox_centers))
+    return list(reversed(line_groups))
 
-    return sorted_bbox_centers
 
+def sort_bbox_centers(bbox_centers: List[Tuple[int, int]], line_threshold: int = 20) -> List:
+    line_groups = sort_line_indices(bbox_centers, line_threshold)
 
-def group_line_chunks(sorted_bbox_centers, lines: List[Line], adaptive_grouping: bool = True):
-    new_line_data = []
-    for bbox_centers in sorted_bbox_centers:
+    return [[bbox_centers[idx] for idx in group] for group in line_groups]
 
-        if len(bbox_centers) > 1:  # i.e. more than 1 bbox center in a group
-            contour_stack = []
 
-            for box_center in bbox_centers:
-                for line_data in lines:
-                    if box_center == line_data.center:
-                        contour_stack.append(line_data.contour)
-                        break
+def merge_line_groups(line_groups: List[List[Line]], adaptive_grouping: bool = True) -> List[Line]:
+    new_line_data = []
+
+    for line_group in line_groups:
+        if len(line_group) > 1:  # i.e. more than 1 bbox center in a group
+            contour_stack = [x.contour for x in line_group]
 
             if adaptive_grouping:
                 for contour in contour_stack:
@@ -704,15 +868,34 @@ def group_line_chunks(sorted_bbox_centers, lines: List[Line], adaptive_grouping:
             new_line_data.append(new_line)
 
         else:
-            for _bcenter in bbox_centers:
-                for line_data in lines:
-                    if _bcenter == line_data.center:
-                        new_line_data.append(line_data)
-                        break
+            new_line_data.extend(line_group)
 
     return new_line_data
 
 
+def group_line_chunks(sorted_bbox_centers, lines: List[Line], adaptive_grouping: bool = True):
+    # chunks sharing a center are matched in order, so that each of them is used once
+    lines_by_center = {}
+
+    for line in lines:
+        lines_by_center.setdefault(line.center, []).append(line)
+
+    line_groups = []
+
+    for bbox_centers in sorted_bbox_centers:
+        line_group = []
+
+        for box_center in bbox_centers:
+            matches = lines_by_center.get(box_center)
+
+            if matches:
+                line_group.append(matches.pop(0))
+
+        line_groups.append(line_group)
+
+    return merge_line_groups(line_groups, adaptive_grouping)
+
+
 def sort_lines_by_threshold(
     line_mask: np.array,
     lines: list[Line],
@@ -720,27 +903,7 @@ def sort_lines_by_threshold(
     calculate_threshold: bool = True,
     group_lines: bool = True
 ):
-    bbox_centers = [x.center for x in lines]
-
-    if calculate_threshold:
-        line_treshold = get_line_threshold(line_mask)
-    else:
-        line_treshold = threshold
-
-    sorted_bbox_centers = sort_bbox_centers(bbox_centers, line_threshold=line_treshold)
-
-    if group_lines:
-        new_lines = group_line_chunks(sorted_bbox_centers, lines)
-    else:
-        _bboxes = [x for xs in sorted_bbox_centers for x in xs]
-
-        new_lines = []
-        for _bbox in _bboxes:
-            for _line in lines:
-                if _bbox == _line.center:
-                    new_lines.append(_line)
-
-    return new_lines, line_treshold
+    return sort_lines_by_threshold2(line_mask, lines, threshold, calculate_threshold, group_lines)
 
 
 def sort_lines_by_threshold2(
@@ -758,36 +921,53 @@ def sort_lines_by_threshold2(
     else:
         line_treshold = threshold
 
-    sorted_bbox_centers = sort_bbox_centers(bbox_centers, line_threshold=line_treshold)
+    line_groups = sort_line_indices(bbox_centers, line_threshold=line_treshold)
+    line_groups = [[lines[idx] for idx in group] for group in line_groups]
 
     if group_lines:
-        new_lines = group_line_chunks(sorted_bbox_centers, lines)
+        new_lines = merge_line_groups(line_groups)
     else:
-        _bboxes = [x for xs in sorted_bbox_centers for x in xs]
-
-        new_lines = []
-        for _bbox in _bboxes:
-            for _line in lines:
-                if _bbox == _line.center:
-                    new_lines.append(_line)
+        new_lines = [x for xs in line_groups for x in xs]
 
     return new_lines, line_treshold
 
 
-def build_raw_line_data(image: npt.NDArray, line_mask: npt.NDArray):
-
+def build_line_mask_data(line_mask: npt.NDArray, angle_epsilon: float = 0.0, rotate_mask: bool = True):
+    """
+    Returns the line mask rotated by the page angle, the line contours in the rotated mask and the angle.
+    Angles up to angle_epsilon are treated as 0, i.e. the page is not rotated at all. Without rotate_mask, the contours
+    are taken from the unrotated mask and rotated instead, and the rotated mask is drawn from them.
+    """
     if len(line_mask.shape) == 3:
         line_mask = cv2.cvtColor(line_mask, cv2.COLOR_BGR2GRAY)
 
-    angle = get_rotation_angle_from_lines(line_mask)
-    rot_mask = rotate_from_angle(line_mask, angle)
-    rot_img = rotate_from_angle(image, angle)
+    line_contours = get_contours(line_mask)
+    angle = get_rotation_angle_from_contours(line_contours, line_mask.shape)
+
+    if abs(angle) <= angle_epsilon:
+        angle = 0.0
+
+    if angle == 0:
+        rot_mask = line_mask
+    elif rotate_mask:
+        rot_mask = rotate_from_angle(line_mask, angle)
+        line_contours = get_contours(rot_mask)
+    else:
+        line_contours = rotate_line_contours(line_contours, line_mask.shape, angle)
+        rot_mask = np.zeros_like(line_mask)
+        cv2.drawContours(rot_mask, line_contours, -1, 255, -1)
 
-    line_contours = get_contours(rot_mask)
     line_contours = [x for x in line_contours if cv2.contourArea(x) > 10]
 
     rot_mask = cv2.cvtColor(rot_mask, cv2.COLOR_GRAY2RGB)
 
+    return rot_mask, line_contours, angle
+
+
+def build_raw_line_data(image: npt.NDArray, line_mask: npt.NDArray):
+    rot_mask, line_contours, angle = build_line_mask_data(line_mask)
+    rot_img = rotate_from_angle(image, angle)
+
     return rot_img, rot_mask, line_contours, angle
 
 def tile_image(padded_img: npt.NDArray, patch_size: int = 512):
@@ -855,41 +1035,163 @@ def filter_line_contours(image: npt.NDArray, line_contours, threshold: float = 0
     return filtered_contours
 
 
-def extract_line(image: npt.NDArray, mask: npt.NDArray, bbox_h: int, k_factor: float = 1.2) -> npt.NDArray:
+def get_line_kernel_size(bbox_h: int, k_factor: float) -> Tuple[int, int]:
     k_size = int(bbox_h * k_factor)
     morph_multiplier = k_factor
 
-    morph_rect = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(k_size, int(k_size * morph_multiplier)))
+    return k_size, int(k_size * morph_multiplier)
+
+
+def get_min_k_factor(bbox_h: int, k_factor: float) -> float:
+    """
+    Returns the k_factor, raised in steps of 0.1 if its dilation kernel for a line of height bbox_h would be smaller
+    than 1x1, e.g. a thin line following a tall one that lowered the k_factor
+    """
+    while True:
+        k_w, k_h = get_line_kernel_size(bbox_h, k_factor)
+
+        if k_factor > 0 and k_w >= 1 and k_h >= 1:
+            return k_factor
+
+        k_factor += 0.1
+
+
+def get_line_roi(
+        bbox: Tuple[int, int, int, int], image_shape: Tuple, bbox_h: int, k_factor: float
+) -> Tuple[int, int, int, int]:
+    """
+    Returns the region (x0, y0, x1, y1) of the image that a line mask with the given bounding box covers after
+    the dilation in extract_line with the same or a smaller k_factor
+    """
+    x, y, w, h = bbox
+    k_w, k_h = get_line_kernel_size(bbox_h, k_factor)
+    pad_x = max(k_w, 0)
+    pad_y = max(k_h, 0)
+
+    return max(x - pad_x, 0), max(y - pad_y, 0), min(x + w + pad_x, image_shape[1]), min(y + h + pad_y, image_shape[0])
+
+
+def extract_line(image: npt.NDArray, mask: npt.NDArray, bbox_h: int, k_factor: float = 1.2) -> npt.NDArray:
+    """
+    Dilates the line mask and crops the masked line from the image. Everything happens within the region of the image
+    the dilated mask can cover, which gives the same result as working on the whole image.
+    """
+    bbox = cv2.boundingRect(mask)
+
+    if bbox[2] == 0 or bbox[3] == 0:
+        # an empty mask crops everything away
+        return mask_n_crop(image[:1, :1], np.zeros((1, 1), dtype=np.uint8))
+
+    x0, y0, x1, y1 = get_line_roi(bbox, image.shape, bbox_h, k_factor)
+    morph_rect = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=get_line_kernel_size(bbox_h, k_factor))
     iterations = 1
-    dilated_mask = cv2.dilate(mask, kernel=morph_rect, iterations=iterations)
-    masked_line = mask_n_crop(image, dilated_mask)
+    dilated_mask = cv2.dilate(mask[y0:y1, x0:x1], kernel=morph_rect, iterations=iterations)
+    masked_line = mask_n_crop(image[y0:y1, x0:x1], dilated_mask)
 
     return masked_line
 
 
 def get_line_image(image: npt.NDArray, mask: npt.NDArray, bbox_h: int, bbox_tolerance: float = 2.5,              k_factor: float = 1.2):
-    tmp_k = k_factor
-    line_img = extract_line(image, mask, bbox_h, k_factor=tmp_k)
+    """
+    Returns the line image of the largest k_factor (going down from the given one in steps of 0.1) whose line image
+    is not higher than bbox_h * bbox_tolerance, and that k_factor. The height of the line image only grows with the
+    k_factor, so the k_factor is searched by bisection, and k_factors with the same dilation kernel are only extracted
+    once. If no k_factor fits, the smallest k_factor with a valid kernel is used, and if the given k_factor has no
+    valid kernel either, the search starts at the smallest one that has, see get_min_k_factor.
+    """
+    max_height = bbox_h * bbox_tolerance
+
+    # built by repeated subtraction to get exactly the same k_factors as stepping down one by one
+    k_factors = [get_min_k_factor(bbox_h, k_factor)]
+
+    while True:
+        next_k = k_factors[-1] - 0.1
+        k_w, k_h = get_line_kernel_size(bbox_h, next_k)
+
+        if next_k <= 0 or k_w < 1 or k_h < 1:
+            break
+
+        k_factors.append(next_k)
+
+    line_images = {}
+
+    def get_image(idx: int) -> npt.NDArray:
+        k_size = get_line_kernel_size(bbox_h, k_factors[idx])
+
+        if k_size not in line_images:
+            line_images[k_size] = extract_line(image, mask, bbox_h, k_factor=k_factors[idx])
+
+        return line_images[k_size]
+
+    if get_image(0).shape[0] <= max_height:
+        return get_image(0), k_factors[0]
+
+    low, high = 0, len(k_factors) - 1
+
+    if get_image(high).shape[0] > max_height:
+        return get_image(high), k_factors[high]
+
+    # the line image of low is too high, the one of high fits
+    while high - low > 1:
+        mid = (low + high) // 2
 
-    while line_img.shape[0] > bbox_h * bbox_tolerance:
-        tmp_k = tmp_k - 0.1
-        line_img = extract_line(image, mask, bbox_h, k_factor=tmp_k)
+        if get_image(mid).shape[0] > max_height:
+            low = mid
+        else:
+            high = mid
+
+    return get_image(high), k_factors[high]
+
+
+def get_line_source(
+        image: npt.NDArray, line_data: List[Line], k_factor: float, angle: float
+) -> Tuple[npt.NDArray, float]:
+    """
+    Returns the image to crop the lines from and the angle that is left to rotate their regions by. The regions of
+    the lines are rotated one by one if they cover less than the page, otherwise the page is rotated once.
+    """
+    if angle == 0:
+        return image, angle
+
+    regions_area = 0
 
-    return line_img, tmp_k
+    for line in line_data:
+        bbox = cv2.boundingRect(line.contour)
+        x0, y0, x1, y1 = get_line_roi(bbox, image.shape, bbox[3], k_factor)
+        regions_area += (x1 - x0) * (y1 - y0)
+
+    if regions_area > image.shape[0] * image.shape[1]:
+        return rotate_from_angle(image, angle), 0.0
 
+    return image, angle
 
-def extract_line_images(image: npt.NDArray, line_data: List[Line], default_k: float = 1.7, bbox_tolerance: float = 3):
+
+def extract_line_images(
+        image: npt.NDArray, line_data: List[Line], default_k: float = 1.7, bbox_tolerance: float = 3, angle: float = 0.0
+):
+    """
+    Extracts the line images of the sorted lines. If the lines are given in the page rotated by angle, the image is
+    the unrotated page, see get_line_source.
+    """
+    image, angle = get_line_source(image, line_data, default_k, angle)
     default_k_factor = default_k
     current_k = default_k_factor
 
     line_images = []
 
     for _, line in enumerate(line_data):
-        _, _, _, h = cv2.boundingRect(line.contour)
-        tmp_mask = np.zeros((image.shape[0], image.shape[1]), dtype=np.uint8)
-        cv2.drawContours(tmp_mask, [line.contour], -1, (255, 255, 255), -1)
+        bbox = cv2.boundingRect(line.contour)
+        h = bbox[3]
+
+        # the k_factor only decreases in get_line_image, so the region of the starting k covers all of its dilations
+        x0, y0, x1, y1 = get_line_roi(bbox, image.shape, h, get_min_k_factor(h, current_k))
+        tmp_mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.drawContours(tmp_mask, [line.contour], -1, (255, 255, 255), -1, offset=(-x0, -y0))
 
-        line_img, adapted_k = get_line_image(image, tmp_mask, h, bbox_tolerance=bbox_tolerance, k_factor=current_k)
+        line_img, adapted_k = get_line_image(
+            crop_rotated_region(image, angle, (x0, y0, x1, y1)), tmp_mask, h, bbox_tolerance=bbox_tolerance,
+            k_factor=current_k
+        )
         line_images.append(line_img)
 
         if current_k != adapted_k:
@@ -905,7 +1207,7 @@ def normalize(image: npt.NDArray) -> npt.NDArray:
 
 
 def binarize(
-        img: npt.NDArray, adaptive: bool = True, block_size: int = 51, c: int = 13
+        img: npt.NDArray, adaptive: bool = True, block_size: int = 51, c: int = 13, to_rgb: bool = True
 ) -> npt.NDArray:
     line_img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
 
@@ -922,7 +1224,9 @@ def binarize(
     else:
         _, bw = cv2.threshold(line_img, 120, 255, cv2.THRESH_BINARY)
 
-    bw = cv2.cvtColor(bw, cv2.COLOR_GRAY2RGB)
+    if to_rgb:
+        bw = cv2.cvtColor(bw, cv2.COLOR_GRAY2RGB)
+
     return bw
 
 def pad_to_width(img: np.array, target_width: int, target_height: int, padding: str) -> np.array:
@@ -1092,74 +1396,60 @@ def apply_global_tps(image: npt.NDArray, line_mask: npt.NDArray, line_data: List
 
     assert input_pts is not None and output_pts is not None
 
-    warped_img = run_tps(image, output_pts, input_pts)
-    warped_mask = run_tps(line_mask, output_pts, input_pts)
+    # the image and the mask share the same warp, so the spline is only evaluated once
+    tps_maps = get_tps_maps(image.shape[0], image.shape[1], output_pts, input_pts)
+    warped_img = remap_tps(image, tps_maps)
+    warped_mask = remap_tps(line_mask, tps_maps, interpolation=cv2.INTER_NEAREST)
 
     return warped_img, warped_mask
 
 
-def check_line_tps(image: npt.NDArray, contour: npt.NDArray, slice_width: int = 40):
-
-    mask = np.zeros(image.shape, dtype=np.uint8)
+def check_line_tps(contour: npt.NDArray, slice_width: int = 40):
+    """
+    Probes the curvature of a line by comparing the centers of five vertical slices across its bbox. Only the bbox of
+    the line is rasterized, so the check does not depend on the size of the page.
+    """
     x, y, w, h = cv2.boundingRect(contour)
 
-    cv2.drawContours(mask, [contour], contourIdx=0, color=(255, 255, 255), thickness=-1)
-
-    slice1_start_x = x
-    slice1_end_x = x+slice_width
-
-    slice2_start_x = x+w//4-slice_width
-    slice2_end_x = x+w//4
-
-    slice3_start_x = x+w//2
-    slice3_end_x = x+w//2+slice_width
-
-    slice4_start_x = x+w//2+w//4
-    slice4_end_x = x+w//2+(w//4)+slice_width
-
-    slice5_start_x = x+w-slice_width
-    slice5_end_x = x+w
+    mask = np.zeros((h, w), dtype=np.uint8)
+    cv2.drawContours(mask, [contour], contourIdx=0, color=255, thickness=-1, offset=(-x, -y))
 
     # define slices along the bbox from left to right
-    slice_1 = mask[y:y+h, slice1_start_x:slice1_end_x, 0]
-    slice_2 = mask[y:y+h, slice2_start_x:slice2_end_x, 0]
-    slice_3 = mask[y:y+h, slice3_start_x:slice3_end_x, 0]
-    slice_4 = mask[y:y+h, slice4_start_x:slice4_end_x, 0]
-    slice_5 = mask[y:y+h, slice5_start_x:slice5_end_x, 0]
-
-    slice1_center_x, slice1_center_y, bbox1_h = get_global_center(slice_1, slice1_start_x, y)
-    slice2_center_x, slice2_center_y, bbox2_h = get_global_center(slice_2, slice2_start_x, y)
-    slice3_center_x, slice3_center_y, bbox3_h = get_global_center(slice_3, slice3_start_x, y)
-    slice4_center_x, slice4_center_y, bbox4_h = get_global_center(slice_4, slice4_start_x, y)
-    slice5_center_x, slice5_center_y, bbox5_h = get_global_center(slice_5, slice5_start_x, y)
-
-    all_bboxes = [bbox1_h, bbox2_h, bbox3_h, bbox4_h, bbox5_h]
-    all_centers = [slice1_center_y, slice2_center_y, slice3_center_y, slice4_center_y, slice5_center_y]
-
-    min_value = min(all_centers)
-    max_value = max(all_centers)
+    slice_starts = [
+        0,
+        w // 4 - slice_width,
+        w // 2,
+        w // 2 + w // 4,
+        w - slice_width
+    ]
+
+    all_centers_x = []
+    all_centers_y = []
+    all_bboxes = []
+
+    for slice_start_x in slice_starts:
+        # the slices of short lines reach beyond the bbox, which has no line pixels anyway
+        slice_end_x = slice_start_x + slice_width
+        slice_start_x = max(0, slice_start_x)
+
+        line_slice = mask[:, slice_start_x:slice_end_x]
+        center_x, center_y, bbox_h = get_global_center(line_slice, x + slice_start_x, y)
+
+        all_centers_x.append(center_x)
+        all_centers_y.append(center_y)
+        all_bboxes.append(bbox_h)
+
+    min_value = min(all_centers_y)
+    max_value = max(all_centers_y)
     max_ydelta = max_value-min_value
     mean_bbox_h = np.mean(all_bboxes)
-    mean_center_y = np.mean(all_centers)
+    mean_center_y = np.mean(all_centers_y)
 
     if max_ydelta > mean_bbox_h:
         target_y = round(mean_center_y)
 
-        input_pts = [
-            [slice1_center_y, slice1_center_x],
-            [slice2_center_y, slice2_center_x],
-            [slice3_center_y, slice3_center_x],
-            [slice4_center_y, slice4_center_x],
-            [slice5_center_y, slice5_center_x]
-        ]
-
-        output_pts = [
-            [target_y, slice1_center_x],
-            [target_y, slice2_center_x],
-            [target_y, slice3_center_x],
-            [target_y, slice4_center_x],
-            [target_y, slice5_center_x]
-        ]
+        input_pts = [[center_y, center_x] for center_x, center_y in zip(all_centers_x, all_centers_y)]
+        output_pts = [[target_y, center_x] for center_x in all_centers_x]
 
         return True, input_pts, output_pts, max_ydelta
     else:
@@ -1167,12 +1457,13 @@ def check_line_tps(image: npt.NDArray, contour: npt.NDArray, slice_width: int =
 
 
 def check_for_tps(image: npt.NDArray, line_contours: List[npt.NDArray]):
+    """
+    Returns the ratio of curved lines and the tps data of each line, including the control points of the curved ones,
+    so that the dewarping can reuse them.
+    """
     line_data = []
     for _, line_cnt in enumerate(line_contours):
-
-        _, y, _, _ = cv2.boundingRect(line_cnt)
-        # TODO: store input and output points to avoid running that step twice
-        tps_status, input_pts, output_pts, max_yd = check_line_tps(image, line_cnt)
+        tps_status, input_pts, output_pts, max_yd = check_line_tps(line_cnt)
 
         line = {
             "contour": line_cnt,
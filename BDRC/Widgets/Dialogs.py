@@ -42,6 +42,8 @@ from BDRC.Data import (
 )
 from BDRC.Exporter import PageXMLExporter, JsonExporter, TextExporter
 from BDRC.Inference import OCRPipeline
+from BDRC.Batch import SharedOCRProcessPool, get_default_workers
+from BDRC.Cache import OCRResultCache
 from BDRC.Runner import OCRBatchRunner, OCRunner
 from BDRC.Utils import import_local_models
 
@@ -864,6 +866,8 @@ class BatchOCRDialog(QDialog):
         ocr_models: List[OCRModel],
         ocr_settings: OCRSettings,
         threadpool: QThreadPool,
+        ocr_cache: OCRResultCache | None = None,
+        process_pool: SharedOCRProcessPool | None = None
     ):
         super().__init__()
         self.setObjectName("BatchOCRDialog")
@@ -872,6 +876,8 @@ class BatchOCRDialog(QDialog):
         self.ocr_models = ocr_models
         self.ocr_settings = ocr_settings
         self.threadpool = threadpool
+        self.ocr_cache = ocr_cache
+        self.process_pool = process_pool
         self.runner = None
         self.output_dir = ""
         self.setWindowTitle("Batch Process")
@@ -1072,10 +1078,14 @@ class BatchOCRDialog(QDialog):
             self.data,
             self.pipeline,
             dewarp=do_dewarp,
+            tps_mode=self.ocr_settings.tps_mode,
             merge_lines=do_merge,
             k_factor=float(k_factor),
             bbox_tolerance=float(bbox_tolerance),
-            target_encoding=encoding
+            target_encoding=encoding,
+            workers=get_default_workers(),
+            cache=self.ocr_cache,
+            process_pool=self.process_pool
         )
 
         self.runner.signals.sample.connect(self.handle_update_progress)
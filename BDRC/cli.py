@@ -0,0 +1,256 @@
+"""
+Headless batch OCR without Qt, e.g.:
+    python -m BDRC.cli scans/ --model-dir OCRModels/Woodblock --output out/ --format xml
+    python -m BDRC.cli "scans/*.tif" volume.pdf --model-dir OCRModels/Woodblock --output out/ --k-factor 2.0
+    python -m BDRC.cli volume.pdf --model-dir OCRModels/Woodblock --output out/ --workers 4
+"""
+
+import os
+import sys
+import cv2
+import glob
+import argparse
+from typing import List
+from platformdirs import user_data_dir
+
+from BDRC.Batch import OCRProcessPool
+from BDRC.Cache import DetectionCache, OCRResultCache, run_cached
+from BDRC.Data import ExportFormat, LineMode, OCRFailure, OpStatus, SessionConfig
+from BDRC.Exporter import PageXMLExporter, JsonExporter, TextExporter
+from BDRC.Inference import OCRPipeline
+from BDRC.Sessions import set_model_cache_dir
+from BDRC.Stages import StagedOCRPipeline
+from BDRC.Utils import (
+    create_dir,
+    extract_pdf_images,
+    get_filename,
+    get_platform,
+    read_layout_model_config,
+    read_line_model_config,
+    read_ocr_model_config,
+    read_ocr_settings
+)
+from Config import APP_NAME, APP_AUTHOR, ENCODINGS, EXPORTERS, LINE_MODES, TPS_MODE
+
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp"]
+EXECUTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAILURE_MESSAGES = {
+    OCRFailure.ImageNotReadable: "the image could not be read",
+    OCRFailure.BlankPage: "blank page",
+    OCRFailure.NoLines: "no text lines found",
+    OCRFailure.Error: "failed to run the OCR"
+}
+
+
+def collect_images(inputs: List[str], tmp_dir: str) -> List[str]:
+    image_paths = []
+
+    for _input in inputs:
+        if os.path.isdir(_input):
+            files = sorted(os.path.join(_input, x) for x in os.listdir(_input))
+        elif os.path.isfile(_input):
+            files = [_input]
+        else:
+            files = sorted(glob.glob(_input))
+
+        for file_path in files:
+            extension = os.path.splitext(file_path)[1].lower()
+
+            if extension == ".pdf":
+                image_paths.extend(extract_pdf_images(file_path, os.path.join(tmp_dir, get_filename(file_path))))
+            elif extension in IMAGE_EXTENSIONS:
+                image_paths.append(file_path)
+
+    return image_paths
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m BDRC.cli", description="Run Tibetan OCR on images and PDF files.")
+    parser.add_argument("inputs", nargs="+", help="image files, directories, glob patterns or PDF files")
+    parser.add_argument("--model-dir", required=True, help="directory of an OCR model containing a model_config.json")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--format", choices=list(EXPORTERS.keys()), default="text")
+    parser.add_argument(
+        "--settings",
+        default=os.path.join(EXECUTION_DIR, "ocr_settings.json"),
+        help="ocr_settings.json to read the defaults of the OCR settings from"
+    )
+    parser.add_argument("--line-model-dir", default=None, help="overrides the bundled line or layout model")
+    parser.add_argument("--line-mode", choices=list(LINE_MODES.keys()), default=None)
+    parser.add_argument("--k-factor", type=float, default=None)
+    parser.add_argument("--bbox-tolerance", type=float, default=None)
+    parser.add_argument("--merge-lines", choices=["yes", "no"], default=None)
+    parser.add_argument("--dewarp", choices=["yes", "no"], default=None)
+    parser.add_argument(
+        "--tps-mode",
+        choices=list(TPS_MODE.keys()),
+        default=None,
+        help="dewarp the whole page or only the region of each curved line"
+    )
+    parser.add_argument("--encoding", choices=list(ENCODINGS.keys()), default=None)
+    parser.add_argument(
+        "--coarse-scale",
+        type=float,
+        default=None,
+        help="detect the text areas on the page downscaled by this factor first (e.g. 0.5) and only run the line model "
+             "on these areas at full resolution, only applies to the line model"
+    )
+    parser.add_argument("--batch-size", type=int, default=8, help="number of lines per recognition run")
+    parser.add_argument(
+        "--beam-threshold",
+        type=float,
+        default=0.8,
+        help="lines are decoded greedily and only the ones with a lower confidence run through the beam search, "
+             "0 only decodes greedily"
+    )
+    parser.add_argument("--threads", type=int, default=0, help="intra-op threads per session, 0 lets onnxruntime decide")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes that run pages in parallel, each one loads its own copy of the models"
+    )
+    parser.add_argument("--decode-threads", type=int, default=1, help="threads reading the images of the next pages")
+    parser.add_argument("--extract-threads", type=int, default=2, help="threads extracting the line images of the pages")
+    parser.add_argument("--cache-dir", default=None, help="directory of the OCR result and line detection caches, defaults to the user data directory")
+    parser.add_argument("--no-cache", action="store_true", help="always run the OCR instead of reusing cached results")
+
+    return parser
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+
+    ocr_settings = read_ocr_settings(args.settings)
+
+    if args.line_mode is not None:
+        ocr_settings.line_mode = LINE_MODES[args.line_mode]
+    if args.k_factor is not None:
+        ocr_settings.k_factor = args.k_factor
+    if args.bbox_tolerance is not None:
+        ocr_settings.bbox_tolerance = args.bbox_tolerance
+    if args.merge_lines is not None:
+        ocr_settings.merge_lines = args.merge_lines == "yes"
+    if args.dewarp is not None:
+        ocr_settings.dewarping = args.dewarp == "yes"
+    if args.tps_mode is not None:
+        ocr_settings.tps_mode = TPS_MODE[args.tps_mode]
+    if args.encoding is not None:
+        ocr_settings.output_encoding = ENCODINGS[args.encoding]
+
+    model_config_file = os.path.join(args.model_dir, "model_config.json")
+
+    if not os.path.isfile(model_config_file):
+        print(f"No model_config.json found in {args.model_dir}", file=sys.stderr)
+        return 1
+
+    ocr_config = read_ocr_model_config(model_config_file)
+
+    if ocr_settings.line_mode == LineMode.Line:
+        line_model_dir = args.line_model_dir or os.path.join(EXECUTION_DIR, "Models", "Lines")
+        line_config = read_line_model_config(line_model_dir)
+    else:
+        line_model_dir = args.line_model_dir or os.path.join(EXECUTION_DIR, "Models", "Layout")
+        line_config = read_layout_model_config(line_model_dir)
+
+    udi = user_data_dir(APP_NAME, APP_AUTHOR)
+    tmp_dir = os.path.join(udi, "tmp", "cli")
+    set_model_cache_dir(os.path.join(udi, "cache", "models"))
+    create_dir(args.output)
+
+    image_paths = collect_images(args.inputs, tmp_dir)
+
+    if len(image_paths) == 0:
+        print("No images found in the given inputs", file=sys.stderr)
+        return 1
+
+    session_config = SessionConfig(intra_op_threads=args.threads) if args.threads > 0 else None
+    ocr_args = {
+        "k_factor": ocr_settings.k_factor,
+        "bbox_tolerance": ocr_settings.bbox_tolerance,
+        "merge_lines": ocr_settings.merge_lines,
+        "use_tps": ocr_settings.dewarping,
+        "tps_mode": ocr_settings.tps_mode,
+        "target_encoding": ocr_settings.output_encoding,
+        "batch_size": args.batch_size,
+        "beam_threshold": args.beam_threshold
+    }
+    detection_cache_dir = None if args.no_cache else os.path.join(args.cache_dir or os.path.join(udi, "cache"), "detection")
+
+    # the sequential pipeline is built once and reused if the cached pages are run after the others
+    staged_pipelines = []
+
+    def run_pages(paths: List[str]):
+        if args.workers > 1 and len(paths) > 1:
+            # the pool is shut down when the results are closed, also if the export fails or is interrupted
+            with OCRProcessPool(
+                get_platform(),
+                ocr_config,
+                line_config,
+                workers=min(args.workers, len(paths)),
+                session_config=session_config,
+                detection_cache_dir=detection_cache_dir,
+                coarse_scale=args.coarse_scale
+            ) as pool:
+                yield from pool.run(paths, **ocr_args)
+        else:
+            if len(staged_pipelines) == 0:
+                pipeline = OCRPipeline(
+                    get_platform(),
+                    ocr_config,
+                    line_config,
+                    session_config=session_config,
+                    detection_cache=DetectionCache(detection_cache_dir) if detection_cache_dir is not None else None,
+                    max_page_states=0,
+                    coarse_scale=args.coarse_scale
+                )
+                staged_pipelines.append(StagedOCRPipeline(
+                    pipeline, decode_workers=args.decode_threads, extract_workers=args.extract_threads
+                ))
+            yield from staged_pipelines[0].run(paths, **ocr_args)
+
+    if args.no_cache:
+        results = run_pages(image_paths)
+    else:
+        cache = OCRResultCache(os.path.join(args.cache_dir or os.path.join(udi, "cache"), "ocr"))
+        detection_settings = OCRPipeline.build_detection_settings(coarse_scale=args.coarse_scale)
+        keys = [cache.build_key(x, ocr_config, line_config, ocr_args, detection_settings) for x in image_paths]
+        results = run_cached(cache, image_paths, keys, run_pages)
+
+    export_format = EXPORTERS[args.format]
+
+    if export_format == ExportFormat.XML:
+        exporter = PageXMLExporter(args.output)
+    elif export_format == ExportFormat.JSON:
+        exporter = JsonExporter(args.output)
+    else:
+        exporter = TextExporter(args.output)
+
+    failed = 0
+
+    try:
+        for idx, status, result in results:
+            image_name = get_filename(image_paths[idx])
+
+            if status != OpStatus.SUCCESS:
+                message = FAILURE_MESSAGES.get(result, FAILURE_MESSAGES[OCRFailure.Error])
+                print(f"[{idx + 1}/{len(image_paths)}] {image_name}: {message}", file=sys.stderr)
+                failed += 1
+                continue
+
+            _, lines, ocr_lines, _ = result
+
+            if export_format == ExportFormat.Text:
+                exporter.export_text(image_name, ocr_lines)
+            else:
+                exporter.export_lines(cv2.imread(image_paths[idx]), image_name, lines, ocr_lines)
+
+            print(f"[{idx + 1}/{len(image_paths)}] {image_name}: {len(ocr_lines)} lines")
+    finally:
+        results.close()
+
+    return 1 if failed == len(image_paths) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,9 @@ from BDRC.Data import (
     OCRArchitecture
 )
 
+APP_NAME = "BDRC_OCR"
+APP_AUTHOR = "BDRC"
+
 """
 Mappings for each data type
 """
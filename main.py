@@ -16,24 +16,31 @@ Note:
 
 import os
 import sys
-from platformdirs import user_data_dir
-from PySide6.QtCore import QPoint
-from BDRC.MVVM.view import AppView
-from BDRC.MVVM.model import OCRDataModel, SettingsModel
-from BDRC.MVVM.viewmodel import DataViewModel, SettingsViewModel
-from BDRC.Utils import get_screen_center, get_platform, create_dir
-from PySide6.QtWidgets import QApplication
-from BDRC.Styles import DARK
-
-APP_NAME = "BDRC_OCR"
-APP_AUTHOR = "BDRC"
+import multiprocessing
 
 
 if __name__ == "__main__":
+    # required for the worker processes of the batch OCR in frozen builds
+    multiprocessing.freeze_support()
+
+    # the spawned workers of the batch OCR import this module as __mp_main__, so the app is only imported here
+    from platformdirs import user_data_dir
+    from PySide6.QtCore import QPoint
+    from BDRC.MVVM.view import AppView
+    from BDRC.MVVM.model import OCRDataModel, SettingsModel
+    from BDRC.MVVM.viewmodel import DataViewModel, SettingsViewModel
+    from BDRC.Utils import get_platform, create_dir
+    from BDRC.QtUtils import get_screen_center
+    from BDRC.Sessions import set_model_cache_dir
+    from PySide6.QtWidgets import QApplication
+    from BDRC.Styles import DARK
+    from Config import APP_NAME, APP_AUTHOR
+
     platform = get_platform()
     execution_dir= os.path.dirname(__file__)
     udi = user_data_dir(APP_NAME, APP_AUTHOR)
     create_dir(udi)
+    set_model_cache_dir(os.path.join(udi, "cache", "models"))
     
     app = QApplication()
     app.setStyleSheet(DARK)
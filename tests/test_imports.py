@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENGINE_MODULES = ["BDRC.Inference", "BDRC.Utils", "BDRC.Batch", "BDRC.Stages", "BDRC.cli"]
+
+
+def test_engine_modules_do_not_import_qt():
+    # run in a fresh interpreter, since other tests may have imported Qt already
+    code = (
+        f"import sys\n"
+        f"import {', '.join(ENGINE_MODULES)}\n"
+        f"qt_modules = sorted(x for x in sys.modules if x.startswith('PySide6'))\n"
+        f"print(','.join(qt_modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == "", f"Qt modules imported by the engine: {result.stdout.strip()}"
+
+
+def test_main_module_does_not_import_qt_in_workers():
+    # the spawned batch workers import the main module as __mp_main__, which must not load the app
+    code = (
+        "import runpy, sys\n"
+        "runpy.run_path('main.py', run_name='__mp_main__')\n"
+        "qt_modules = sorted(x for x in sys.modules if x.startswith('PySide6'))\n"
+        "print(','.join(qt_modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == "", f"Qt modules imported by main.py: {result.stdout.strip()}"
@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+
+from BDRC.Utils import build_line_data, extract_line_images, get_line_kernel_size, get_min_k_factor
+
+
+def build_line(page_shape, x0: int, y0: int, x1: int, y1: int):
+    mask = np.zeros(page_shape, dtype=np.uint8)
+    cv2.rectangle(mask, (x0, y0), (x1, y1), 255, -1)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    return build_line_data(contours[0])
+
+
+def test_thin_line_after_tall_line():
+    # the tall line lowers the k_factor until its kernel would be empty for the thin line
+    image = np.full((400, 1200, 3), 255, dtype=np.uint8)
+    lines = [build_line(image.shape[:2], 50, 50, 1000, 119), build_line(image.shape[:2], 50, 250, 1000, 256)]
+
+    line_images = extract_line_images(image, lines, 2.5, 1.0)
+
+    assert len(line_images) == 2
+    assert all(x.shape[0] > 0 and x.shape[1] > 0 for x in line_images)
+
+
+def test_min_k_factor_has_valid_kernel():
+    for bbox_h in [1, 2, 7, 30, 120]:
+        for k_factor in [-0.3, 0.0, 0.05, 0.2, 1.7]:
+            min_k = get_min_k_factor(bbox_h, k_factor)
+            k_w, k_h = get_line_kernel_size(bbox_h, min_k)
+
+            assert min_k >= k_factor
+            assert k_w >= 1 and k_h >= 1
+
+
+def test_min_k_factor_keeps_valid_k_factor():
+    assert get_min_k_factor(40, 1.7) == 1.7
@@ -0,0 +1,129 @@
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+
+from BDRC.Data import Line
+from BDRC.Utils import build_line_data, get_contours, get_line_threshold, sort_lines_by_threshold2
+
+
+def sort_bbox_centers_by_scan(bbox_centers, line_threshold: float = 20) -> List:
+    # the scan-based implementation that sort_lines_by_threshold2 has to agree with
+    sorted_bbox_centers = []
+    tmp_line = []
+
+    for bbox_center in bbox_centers:
+        if len(tmp_line) > 0:
+            mean_y = np.mean([y[1] for y in tmp_line])
+
+            if abs(mean_y - bbox_center[1]) > line_threshold:
+                tmp_line.sort(key=lambda x: x[0])
+                sorted_bbox_centers.append(tmp_line.copy())
+                tmp_line.clear()
+
+        tmp_line.append(bbox_center)
+
+    sorted_bbox_centers.append(tmp_line)
+
+    for y in sorted_bbox_centers:
+        y.sort(key=lambda x: x[0])
+
+    return list(reversed(sorted_bbox_centers))
+
+
+def sort_lines_by_scan(line_mask, lines: List[Line], group_lines: bool = True):
+    sorted_bbox_centers = sort_bbox_centers_by_scan([x.center for x in lines], get_line_threshold(line_mask))
+    new_lines = []
+
+    for bbox_centers in sorted_bbox_centers:
+        if group_lines and len(bbox_centers) > 1:
+            # every center is matched to the first chunk with that center
+            contour_stack = [next(x.contour for x in lines if x.center == center) for center in bbox_centers]
+            stacked_contour = cv2.convexHull(np.vstack(contour_stack))
+            new_lines.append(stacked_contour)
+        elif group_lines:
+            new_lines.append(next(x.contour for x in lines if x.center == bbox_centers[0]))
+        else:
+            new_lines.extend(x.contour for center in bbox_centers for x in lines if x.center == center)
+
+    return new_lines
+
+
+def fragmented_page(rng: np.random.Generator) -> np.ndarray:
+    # rows of line chunks with gaps, a slight slope and some jitter
+    height, width = int(rng.integers(400, 2000)), int(rng.integers(800, 4000))
+    mask = np.zeros((height, width), dtype=np.uint8)
+    rows = int(rng.integers(2, 15))
+    slope = rng.uniform(-0.02, 0.02)
+
+    for row in range(rows):
+        y_row = int(height * (row + 0.5) / rows)
+        x = int(rng.integers(0, 100))
+
+        while x < width - 20:
+            chunk_width = int(rng.integers(20, 400))
+            y = y_row + int(slope * x) + int(rng.integers(-4, 5))
+            cv2.rectangle(mask, (x, y), (x + chunk_width, y + int(rng.integers(8, 30))), 255, -1)
+            x += chunk_width + int(rng.integers(5, 120))
+
+    return mask
+
+
+def get_lines(mask: np.ndarray) -> List[Line]:
+    return [build_line_data(x) for x in get_contours(mask)]
+
+
+def assert_same_contours(contours, expected_contours):
+    assert len(contours) == len(expected_contours)
+
+    for contour, expected_contour in zip(contours, expected_contours):
+        assert np.array_equal(contour, expected_contour)
+
+
+@pytest.mark.parametrize("group_lines", [True, False])
+def test_sort_lines_matches_scan(group_lines):
+    rng = np.random.default_rng(0)
+
+    for _ in range(30):
+        mask = fragmented_page(rng)
+        lines = get_lines(mask)
+        new_lines, _ = sort_lines_by_threshold2(mask, lines, group_lines=group_lines)
+
+        assert_same_contours([x.contour for x in new_lines], sort_lines_by_scan(mask, lines, group_lines))
+
+
+def test_sort_lines_with_duplicate_centers():
+    mask = fragmented_page(np.random.default_rng(1))
+    lines = []
+
+    # every third chunk is followed by a chunk with the same bbox center, but another shape
+    for idx, line in enumerate(get_lines(mask)):
+        lines.append(line)
+
+        if idx % 3 == 0:
+            x, y = line.center
+            contour = np.array([[[x - 3, y - 2]], [[x + 3, y - 2]], [[x + 3, y + 2]], [[x - 3, y + 2]]], dtype=np.int32)
+            duplicate = build_line_data(contour, optimize=False)
+            assert duplicate.center == line.center
+            lines.append(duplicate)
+
+    # the scan matched every center to all chunks with that center, so these came twice
+    expected_contours = []
+
+    for contour in sort_lines_by_scan(mask, lines, group_lines=False):
+        if not any(contour is x for x in expected_contours):
+            expected_contours.append(contour)
+
+    new_lines, _ = sort_lines_by_threshold2(mask, lines, group_lines=False)
+    assert_same_contours([x.contour for x in new_lines], expected_contours)
+
+    # the scan merged the first chunk of a center twice, while every chunk is merged once now
+    new_lines, _ = sort_lines_by_threshold2(mask, lines)
+    scan_contours = sort_lines_by_scan(mask, lines)
+    assert len(new_lines) == len(scan_contours)
+
+    for line, scan_contour in zip(new_lines, scan_contours):
+        x, y, w, h = cv2.boundingRect(scan_contour)
+        assert line.bbox.x <= x and line.bbox.y <= y
+        assert line.bbox.x + line.bbox.w >= x + w and line.bbox.y + line.bbox.h >= y + h
@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+import pytest
+
+from BDRC.Utils import get_line_threshold
+
+
+def get_line_threshold_per_slice(line_prediction, slice_width: int = 20) -> float:
+    # the slice-by-slice implementation that get_line_threshold has to agree with
+    x, y, w, h = cv2.boundingRect(line_prediction)
+    x_steps = (w // slice_width) // 2
+    bbox_numbers = []
+
+    for step in range(1, x_steps + 1):
+        x_start = x + x_steps * step
+        _slice = line_prediction[y: y + h, x_start:x_start + slice_width]
+        contours, _ = cv2.findContours(_slice, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        bbox_numbers.append((len(contours), contours))
+
+    if len(bbox_numbers) == 0:
+        return 0.0
+
+    n_contours, contours = sorted(bbox_numbers, key=lambda item: item[0], reverse=True)[0]
+
+    if n_contours == 0:
+        return 0.0
+
+    y_points = []
+
+    for contour in contours:
+        _, c_y, _, c_h = cv2.boundingRect(contour)
+        y_points.append(c_y + (c_h // 2))
+
+    return float(np.median(y_points) // n_contours)
+
+
+def fragmented_mask(rng: np.random.Generator) -> np.ndarray:
+    height, width = int(rng.integers(200, 2000)), int(rng.integers(300, 5000))
+    mask = np.zeros((height, width), dtype=np.uint8)
+
+    for _ in range(int(rng.integers(5, 400))):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        cv2.rectangle(mask, (x, y), (x + int(rng.integers(1, 15)), y + int(rng.integers(1, 40))), 255, -1)
+
+    return mask
+
+
+def line_chunk_mask(rng: np.random.Generator) -> np.ndarray:
+    height, width = int(rng.integers(400, 2500)), int(rng.integers(500, 6000))
+    mask = np.zeros((height, width), dtype=np.uint8)
+    rows = int(rng.integers(2, 12))
+
+    for row in range(rows):
+        y = int(height * (row + 0.5) / rows)
+
+        for _ in range(int(rng.integers(1, 10))):
+            x = int(rng.integers(0, width))
+            line_height = int(rng.integers(3, max(4, height // rows // 2)))
+            cv2.rectangle(mask, (x, y), (x + int(rng.integers(3, 800)), y + line_height), 255, -1)
+
+    return mask
+
+
+def blob_mask(rng: np.random.Generator) -> np.ndarray:
+    # blurred noise gives blobs with holes
+    noise = rng.random((int(rng.integers(200, 1500)), int(rng.integers(300, 3000))))
+    return ((cv2.GaussianBlur(noise, (0, 0), int(rng.integers(1, 6))) > 0.5) * 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("build_mask", [fragmented_mask, line_chunk_mask, blob_mask])
+def test_line_threshold_matches_per_slice_contours(build_mask):
+    rng = np.random.default_rng(0)
+
+    for _ in range(30):
+        mask = build_mask(rng)
+        assert get_line_threshold(mask) == get_line_threshold_per_slice(mask)
+
+
+def test_line_threshold_of_empty_mask():
+    assert get_line_threshold(np.zeros((100, 400), dtype=np.uint8)) == 0.0